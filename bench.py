@@ -0,0 +1,219 @@
+"""
+Control path benchmark.
+
+Feeds synthetic or recorded joystick event streams through GamePad dispatch into Car
+with mock hardware and reports throughput, CPU time, PWM writes and I2C transactions per event
+and queue to flush latency. Results can be stored as baseline and compared with it.
+
+Throughput and CPU time depend on the machine, so the baseline is not kept in the repository.
+Store it on the target (e.g. the car's Pi) before a change with --save, then run without --save
+after the change to check for regressions. The default baseline file is ignored by git.
+
+Usage: python3 bench.py [--events N] [--repeat N] [--replay FILE] [--save] [--baseline FILE] [--threshold 0.1]
+"""
+import os
+
+os.environ['CAR_HARDWARE'] = 'mock'
+
+import argparse
+import json
+import math
+import sys
+import time
+import car
+import config
+import gamepad
+import latency
+from control import ControlLoop
+
+AXIS_MAP = [
+    gamepad.AXIS_X, gamepad.AXIS_Y, gamepad.AXIS_Z, gamepad.AXIS_RX, gamepad.AXIS_RY, gamepad.AXIS_RZ,
+    gamepad.AXIS_GAS, gamepad.AXIS_BRAKE, gamepad.AXIS_HAT0X, gamepad.AXIS_HAT0Y
+]
+""" Axis map of emulated gamepad """
+BUTTONS_MAP = [gamepad.BTN_A, gamepad.BTN_B, gamepad.BTN_X, gamepad.BTN_Y]
+""" Buttons map of emulated gamepad """
+BATCH = 4
+""" Number of events available for one GamePad.process call """
+BASELINE = 'bench_baseline.json'
+""" Default baseline file, generated by --save on the measured machine """
+HIGHER_IS_BETTER = ('events_per_sec',)
+CHECKED = ('events_per_sec', 'cpu_us_per_event', 'i2c_per_event')
+""" Metrics checked for regression """
+
+
+def axis_event(time_ms, axis, value):
+    return time_ms, int(value), gamepad.JS_EVENT_AXIS, AXIS_MAP.index(axis)
+
+
+def button_event(time_ms, button, value):
+    return time_ms, value, gamepad.JS_EVENT_BUTTON, BUTTONS_MAP.index(button)
+
+
+def slalom(count):
+    """ Steering wheel sine sweeps with constant throttle """
+    events = [axis_event(0, gamepad.AXIS_GAS, 16000)]
+    for i in range(1, count):
+        events.append(axis_event(i * 4, gamepad.AXIS_X, 32767 * math.sin(i / 50)))
+    return events
+
+
+def trigger_mashing(count):
+    """ Throttle and reverse triggers pressed and released in turn """
+    events = []
+    for i in range(0, count):
+        axis = gamepad.AXIS_GAS if (i // 40) % 2 else gamepad.AXIS_BRAKE
+        value = 32767 * math.sin(i * math.pi / 20)
+        events.append(axis_event(i * 4, axis, value if value > 0 else -32767))
+    return events
+
+
+def brake_spam(count):
+    """ Brake button pressed and released with throttle held """
+    events = [axis_event(0, gamepad.AXIS_GAS, 32767)]
+    for i in range(1, count):
+        events.append(button_event(i * 4, gamepad.BTN_B, (i // 3) % 2))
+    return events
+
+
+SCENARIOS = {
+    'slalom': slalom,
+    'trigger_mashing': trigger_mashing,
+    'brake_spam': brake_spam,
+}
+
+
+def load_replay(path):
+    """
+    Load raw joystick events (8 bytes records as read from /dev/input/jsX)
+
+    :param path: file path
+    :return: list of events
+    """
+    with open(path, 'rb') as file:
+        data = file.read()
+    data = data[:len(data) - len(data) % gamepad.JS_EVENT.size]
+    return [event for event in gamepad.JS_EVENT.iter_unpack(data) if not event[2] & gamepad.JS_EVENT_INIT]
+
+
+def run(events, control_loop=False):
+    """
+    Run events through GamePad and Car
+
+    :param events: list of (time, value, type, number)
+    :param control_loop: use fixed-rate control loop
+    :return: dictionary of metrics
+    """
+    tracer = latency.enable()
+    my_car = car.Car(steering_table=config.STEERING_TABLE, batched_pwm=config.BATCHED_PWM)
+    control = ControlLoop(my_car.pwm) if control_loop else None
+    if control:
+        control.start()
+    pad = gamepad.GamePad()
+    read_fd, write_fd = os.pipe()
+    os.set_blocking(read_fd, False)
+    pad.attach_device(read_fd, AXIS_MAP, BUTTONS_MAP)
+    my_car.attach_gamepad(pad, control)
+    device = my_car.pwm.pwm._device
+    time.sleep(0.05)
+    transactions = len(device.transactions)
+    tracer.reset()
+
+    packed = [gamepad.JS_EVENT.pack(*event) for event in events]
+    cpu_start = time.process_time()
+    start = time.perf_counter()
+    for i in range(0, len(packed), BATCH):
+        os.write(write_fd, b''.join(packed[i:i + BATCH]))
+        pad.process()
+    if control:
+        control.stop()
+        control.tick()
+    my_car.close()
+    elapsed = time.perf_counter() - start
+    cpu = time.process_time() - cpu_start
+    os.close(read_fd)
+    os.close(write_fd)
+    latency.tracer = None
+
+    count = len(events)
+    flush = tracer.histograms['flush']
+    return {
+        'events': count,
+        'events_per_sec': count / elapsed,
+        'cpu_us_per_event': cpu * 1000000 / count,
+        'pwm_writes_per_event': my_car.pwm.writes_issued / count,
+        'i2c_per_event': (len(device.transactions) - transactions) / count,
+        'flush_p50_us': flush.percentile(50),
+        'flush_p99_us': flush.percentile(99),
+    }
+
+
+def compare(results, baseline, threshold):
+    """
+    Compare results with baseline
+
+    :param results: scenario -> metrics
+    :param baseline: scenario -> metrics
+    :param threshold: allowed relative degradation
+    :return: list of regression messages
+    """
+    regressions = []
+    for scenario, metrics in results.items():
+        base = baseline.get(scenario)
+        if not base:
+            continue
+        for name in CHECKED:
+            if not base.get(name):
+                continue
+            change = (metrics[name] - base[name]) / base[name]
+            if name in HIGHER_IS_BETTER:
+                change = -change
+            if change > threshold:
+                regressions.append("{} {}: {:.3f} -> {:.3f} ({:+.1%})".format(
+                    scenario, name, base[name], metrics[name], change))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Control path benchmark")
+    parser.add_argument('--events', type=int, default=20000, help="number of events in synthetic scenarios")
+    parser.add_argument('--repeat', type=int, default=3, help="number of runs of every scenario, the best is reported")
+    parser.add_argument('--replay', help="file with recorded raw joystick events")
+    parser.add_argument('--control-loop', action='store_true', help="use fixed-rate control loop")
+    parser.add_argument('--baseline', default=BASELINE, help="baseline file")
+    parser.add_argument('--save', action='store_true', help="store results as baseline")
+    parser.add_argument('--threshold', type=float, default=0.1, help="allowed relative degradation")
+    args = parser.parse_args()
+
+    if args.replay:
+        scenarios = {os.path.basename(args.replay): load_replay(args.replay)}
+    else:
+        scenarios = {name: func(args.events) for name, func in SCENARIOS.items()}
+
+    results = {}
+    print("{:<18}{:>10}{:>12}{:>10}{:>10}{:>10}{:>10}".format(
+        'scenario', 'events', 'events/s', 'cpu us', 'writes', 'i2c', 'p99 us'))
+    for name, events in scenarios.items():
+        metrics = max((run(events, args.control_loop) for _ in range(0, args.repeat)),
+                      key=lambda result: result['events_per_sec'])
+        results[name] = metrics
+        print("{:<18}{:>10}{:>12.0f}{:>10.1f}{:>10.2f}{:>10.2f}{:>10}".format(
+            name, metrics['events'], metrics['events_per_sec'], metrics['cpu_us_per_event'],
+            metrics['pwm_writes_per_event'], metrics['i2c_per_event'], metrics['flush_p99_us']))
+
+    if args.save:
+        with open(args.baseline, 'w') as file:
+            json.dump(results, file, indent=2)
+        print("Baseline is saved to {}".format(args.baseline))
+        return 0
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as file:
+            regressions = compare(results, json.load(file), args.threshold)
+        for message in regressions:
+            print("REGRESSION: {}".format(message))
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
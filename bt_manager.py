@@ -0,0 +1,177 @@
+import threading
+import time
+
+BLUEZ_SERVICE = 'org.bluez'
+DEVICE_INTERFACE = 'org.bluez.Device1'
+PROPERTIES_INTERFACE = 'org.freedesktop.DBus.Properties'
+
+CONNECTING = 'connecting'
+CONNECTED = 'connected'
+DISCONNECTED = 'disconnected'
+FAILED = 'failed'
+
+
+class BluetoothManager:
+    """
+    Bluetooth gamepad connection manager.
+
+    Keeps one system bus connection, connects the device in the worker thread with exponential backoff
+    and learns connection state from BlueZ PropertiesChanged signals. Unexpected disconnect starts
+    reconnection immediately.
+    """
+
+    def __init__(self,
+                 address: str,
+                 adapter: str = 'hci0',
+                 on_state=None,
+                 retries: int = 5,
+                 min_delay: float = 0.1,
+                 max_delay: float = 5.0,
+                 timeout: float = 10.0):
+        """
+        :param address: MAC address of the gamepad
+        :param adapter: bluetooth adapter name
+        :param on_state: callback func(state) called with CONNECTING, CONNECTED, DISCONNECTED or FAILED
+        :param retries: number of connection attempts for one request
+        :param min_delay: delay after the first failed attempt (seconds), doubled after every attempt
+        :param max_delay: maximum delay between attempts (seconds)
+        :param timeout: D-Bus Connect call timeout (seconds)
+        """
+        self.address = address
+        self.device_path = '/org/bluez/{}/dev_{}'.format(adapter, address.replace(':', '_'))
+        self.on_state = on_state
+        self.retries = retries
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self.timeout = timeout
+        self.connected = False
+        self.reconnects = 0
+        """ Number of connection requests """
+        self.connect_attempts = 0
+        self.reconnect_seconds = 0.0
+        """ Total duration of successful reconnections """
+        self._connecting_since = None
+        self._bus = None
+        self._device = None
+        self._loop = None
+        self._request = threading.Event()
+        self._is_stopped = False
+        self._worker = threading.Thread(target=self._run, daemon=True)
+        self._loop_thread = None
+
+    def start(self):
+        """
+        Connect to system bus and subscribe to device signals
+
+        :return: None
+        """
+        import pydbus
+        from gi.repository import GLib
+        self._bus = pydbus.SystemBus()
+        self._bus.subscribe(sender=BLUEZ_SERVICE,
+                            iface=PROPERTIES_INTERFACE,
+                            signal='PropertiesChanged',
+                            object=self.device_path,
+                            signal_fired=self._on_properties_changed)
+        self._loop = GLib.MainLoop()
+        self._loop_thread = threading.Thread(target=self._loop.run, daemon=True)
+        self._loop_thread.start()
+        try:
+            self.connected = bool(self._get_device().Connected)
+        except Exception as err:
+            print("Bluetooth: {}".format(str(err)))
+        self._worker.start()
+
+    def stop(self):
+        self._is_stopped = True
+        self._request.set()
+        if self._loop:
+            self._loop.quit()
+
+    def connect(self):
+        """
+        Request connection. Returns immediately, connection is made in the worker thread.
+
+        :return: None
+        """
+        if self.connected:
+            print("Bluetooth: gamepad is already connected")
+            return
+        self._request.set()
+
+    def _get_device(self):
+        if self._device is None:
+            self._device = self._bus.get(BLUEZ_SERVICE, self.device_path)
+        return self._device
+
+    def _set_state(self, state):
+        if self.on_state:
+            self.on_state(state)
+
+    def _on_properties_changed(self, sender, obj, iface, signal, params):
+        interface, changed, invalidated = params
+        if interface != DEVICE_INTERFACE or 'Connected' not in changed:
+            return
+        connected = bool(changed['Connected'])
+        if connected == self.connected:
+            return
+        self.connected = connected
+        if connected:
+            print("Bluetooth is connected")
+            if self._connecting_since is not None:
+                self.reconnect_seconds += time.monotonic() - self._connecting_since
+                self._connecting_since = None
+            self._set_state(CONNECTED)
+        else:
+            print("Bluetooth is disconnected")
+            self._set_state(DISCONNECTED)
+            # reconnect after dropout
+            self._request.set()
+
+    def _run(self):
+        while True:
+            self._request.wait()
+            self._request.clear()
+            if self._is_stopped:
+                return
+            if self.connected:
+                continue
+            self._set_state(CONNECTING)
+            self.reconnects += 1
+            self._connecting_since = time.monotonic()
+            delay = self.min_delay
+            for i in range(0, self.retries):
+                try:
+                    print("Bluetooth: connection try #{}".format(i))
+                    self.connect_attempts += 1
+                    self._get_device().Connect(timeout=self.timeout)
+                    break
+                except Exception as err:
+                    print("Bluetooth: {}".format(str(err)))
+                    # proxy is recreated if the device object was removed
+                    self._device = None
+                if self.connected or self._is_stopped:
+                    break
+                self._request.wait(delay)
+                self._request.clear()
+                if self._is_stopped:
+                    return
+                delay = min(delay * 2, self.max_delay)
+            else:
+                print("Bluetooth connection error")
+                self._connecting_since = None
+                self._set_state(FAILED)
+
+    def metrics(self):
+        """
+        Metrics source, see metrics.Metrics.add_source
+
+        :return: list of (name, type, help, value)
+        """
+        return [
+            ('car_bluetooth_connected', 'gauge', "Gamepad is connected", int(self.connected)),
+            ('car_bluetooth_reconnects_total', 'counter', "Connection requests", self.reconnects),
+            ('car_bluetooth_connect_attempts_total', 'counter', "Connect calls", self.connect_attempts),
+            ('car_bluetooth_reconnect_seconds_total', 'counter', "Time spent reconnecting successfully",
+             self.reconnect_seconds),
+        ]
@@ -1,7 +1,11 @@
-import Adafruit_PCA9685
-from steering import Steering
-from pwm_manager import PWM
-from gpiozero import LED, Button
+import threading
+from steering import Steering, calc_differential
+from profiles import DriveProfile, CompiledProfile
+from pwm_manager import PWM, SAFETY, AUX
+import gamepad
+from control import RampEngine, Failsafe
+from input_map import InputMap
+from hardware import LED, Button
 
 SERVO_0 = 110
 """ Servo value for 0 degrees """
@@ -16,6 +20,26 @@ MIN_ANGLE = 45
 MIN_CAMERA_ANGLE = 40
 MAX_CAMERA_ANGLE = 150
 
+STICK_DEADZONE = 0.04
+""" Part of stick travel around the center ignored as noise """
+TRIGGER_DEADZONE = 0.02
+""" Part of trigger travel at the released position ignored as noise """
+
+AUX_DEADLINE = 0.1
+""" Maximum age of queued light and camera values (seconds), stale ones yield the bus to motors and steering """
+
+PROFILES = [
+    DriveProfile('novice', throttle=0.4, expo=0.5, steering_angle=30,
+                 camera_min_angle=60, camera_max_angle=130),
+    DriveProfile('normal', steering_angle=MIN_ANGLE,
+                 camera_min_angle=MIN_CAMERA_ANGLE, camera_max_angle=MAX_CAMERA_ANGLE),
+    DriveProfile('sport', expo=0.3, steering_angle=MIN_ANGLE,
+                 camera_min_angle=MIN_CAMERA_ANGLE, camera_max_angle=MAX_CAMERA_ANGLE),
+    DriveProfile('precision', throttle=0.6, expo=0.7, steering_angle=35,
+                 camera_min_angle=MIN_CAMERA_ANGLE, camera_max_angle=MAX_CAMERA_ANGLE),
+]
+""" Drive profiles selected by mode button, mode 1 is the default """
+
 
 def map_range(x, in_min, in_max, out_min, out_max):
     return (x - in_min) * (out_max - out_min) / (in_max - in_min) + out_min
@@ -28,19 +52,29 @@ class ServoMotor:
         self._channel = channel
         self.last_angle = 0
 
-    def set_angle(self, value):
-        servo_value = int(map_range(value, 0, 180, SERVO_0, SERVO_180))
+    def set_angle(self, value, priority=None):
+        self.set_value(int(map_range(value, 0, 180, SERVO_0, SERVO_180)), priority)
+
+    def set_value(self, servo_value, priority=None):
         if self.last_angle != servo_value:
-            self._pwm.set_pwm(self._channel, 0, servo_value)
+            self._pwm.set_pwm(self._channel, 0, servo_value, priority)
             self.last_angle = servo_value
 
 
 class DCMotor:
     """
-    Class for controlling DC motor
+    Class for controlling DC motor.
+    With acceleration or deceleration limit the duty moves toward the target on every step() call.
     """
 
-    def __init__(self, pwm: PWM, channel_fwd: int, channel_rev: int):
+    def __init__(self, pwm: PWM, channel_fwd: int, channel_rev: int, acceleration=None, deceleration=None):
+        """
+        :param pwm: PWM manager
+        :param channel_fwd: forward channel
+        :param channel_rev: reverse channel
+        :param acceleration: maximum duty increase (full scale per second), None - no limit
+        :param deceleration: maximum duty decrease (full scale per second), None - no limit
+        """
         self._pwm = pwm
         self._channel_fwd = channel_fwd
         self._channel_rev = channel_rev
@@ -48,33 +82,88 @@ class DCMotor:
         self._speed_rev = 0
         self._brake = False
         self._differential = 1
-
-    def _update_speed(self):
+        self._acceleration = acceleration * 4095 if acceleration else None
+        self._deceleration = deceleration * 4095 if deceleration else None
+        self._duty = 0
+        """ Duty written to the motor, negative for reverse """
+        self._target = 0
+        self._lock = threading.Lock()
+
+    @property
+    def ramped(self):
+        return self._acceleration is not None or self._deceleration is not None
+
+    def _update_speed(self, priority=None):
         """
         Update speed of motor depending of class members.
+        Brake and SAFETY updates bypass the ramp.
 
-
+        :param priority: PWM write priority, brake is always written with SAFETY priority
         :return: None
         """
-        if self._brake:
-            self._pwm.set_pwm(self._channel_fwd, 0, 4095)
-            self._pwm.set_pwm(self._channel_rev, 0, 4095)
+        with self._lock:
+            if self._brake:
+                self._duty = 0
+                self._pwm.set_pwm(self._channel_fwd, 0, 4095, SAFETY)
+                self._pwm.set_pwm(self._channel_rev, 0, 4095, SAFETY)
+                return
+            self._target = int((self._speed_fwd - self._speed_rev) * self._differential)
+            if priority == SAFETY or not self.ramped:
+                self._duty = self._target
+            # unchanged duty is suppressed by PWM, after brake it releases the channels
+            self._write_duty(priority)
+
+    def _write_duty(self, priority=None):
+        if self._duty > 0:
+            self._pwm.set_pwm(self._channel_fwd, 0, self._duty, priority)
+            self._pwm.set_pwm(self._channel_rev, 0, 0, priority)
         else:
-            if self._speed_fwd > self._speed_rev:
-                speed = int((self._speed_fwd - self._speed_rev) * self._differential)
-                self._pwm.set_pwm(self._channel_fwd, 0, speed)
-                self._pwm.set_pwm(self._channel_rev, 0, 0)
+            self._pwm.set_pwm(self._channel_fwd, 0, 0, priority)
+            self._pwm.set_pwm(self._channel_rev, 0, -self._duty, priority)
+
+    def step(self, period):
+        """
+        Move duty toward the target within acceleration and deceleration limits.
+        Direction change decelerates to zero first.
+
+        :param period: time since the previous step (seconds)
+        :return: True if duty is changed
+        """
+        with self._lock:
+            duty = self._duty
+            target = self._target
+            if self._brake or duty == target:
+                return False
+            if (duty > 0 and target < duty) or (duty < 0 and target > duty):
+                limit = self._deceleration
+                step = max(limit * period, 1) if limit is not None else abs(duty)
+                if duty > 0:
+                    duty = max(target, duty - step, 0)
+                else:
+                    duty = min(target, duty + step, 0)
             else:
-                speed = int((self._speed_rev - self._speed_fwd) * self._differential)
-                self._pwm.set_pwm(self._channel_fwd, 0, 0)
-                self._pwm.set_pwm(self._channel_rev, 0, speed)
+                limit = self._acceleration
+                step = max(limit * period, 1) if limit is not None else abs(target - duty)
+                if target > duty:
+                    duty = min(target, duty + step)
+                else:
+                    duty = max(target, duty - step)
+            self._duty = int(duty)
+            self._write_duty()
+            return True
 
     def forward(self, value, min_value, max_value):
-        self._speed_fwd = int(map_range(value, min_value, max_value, 0, 4095))
-        self._update_speed()
+        self.set_forward(int(map_range(value, min_value, max_value, 0, 4095)))
 
     def reverse(self, value, min_value, max_value):
-        self._speed_rev = int(map_range(value, min_value, max_value, 0, 4095))
+        self.set_reverse(int(map_range(value, min_value, max_value, 0, 4095)))
+
+    def set_forward(self, speed):
+        self._speed_fwd = speed
+        self._update_speed()
+
+    def set_reverse(self, speed):
+        self._speed_rev = speed
         self._update_speed()
 
     def brake(self, value):
@@ -84,7 +173,7 @@ class DCMotor:
     def stop(self):
         self._speed_fwd = 0
         self._speed_rev = 0
-        self._update_speed()
+        self._update_speed(SAFETY)
 
     def set_differential(self, diff):
         self._differential = diff
@@ -96,16 +185,39 @@ class Car:
     Class for controlling the car
     """
 
-    def __init__(self):
-        self.pwm = PWM(16)
-        self.pwm.start()
+    def __init__(self, steering_table=False, batched_pwm=False, pwm_thread=True, pwm_addresses=(0x40,),
+                 acceleration=None, deceleration=None, pwm=None, failsafe_timeout=None):
+        """
+        :param steering_table: use precomputed steering lookup tables instead of exact steering math
+        :param batched_pwm: write PWM channels with batched I2C transactions
+        :param pwm_thread: write PWM channels in the worker thread, otherwise owner calls pwm.flush()
+            and runs ramp.run_async()
+        :param pwm_addresses: I2C addresses of PCA9685 boards, channels of next boards start from 16, 32, ...
+        :param acceleration: motor acceleration limit (full scale per second), None - no limit
+        :param deceleration: motor deceleration limit (full scale per second), None - no limit
+        :param pwm: already started PWM writer, e.g. shared_pwm.SharedPWM, batched_pwm and pwm_addresses are ignored
+        :param failsafe_timeout: stop the car after input silence (seconds), None - no failsafe.
+            Only gamepads with periodic_reports feed the failsafe
+        """
+        if pwm is None:
+            pwm = PWM(16 * len(pwm_addresses), batched=batched_pwm, addresses=pwm_addresses)
+            if pwm_thread:
+                pwm.start()
+        self.pwm = pwm
         self.light_level = 0
         # self.pwm.set_pwm_freq(60)
         self.steering_wheel_left = ServoMotor(self.pwm, 0)
         self.steering_wheel_right = ServoMotor(self.pwm, 1)
-        self.left_motor = DCMotor(self.pwm, 2, 3)
-        self.right_motor = DCMotor(self.pwm, 4, 5)
+        self.left_motor = DCMotor(self.pwm, 2, 3, acceleration, deceleration)
+        self.right_motor = DCMotor(self.pwm, 4, 5, acceleration, deceleration)
+        self.ramp = None
+        if acceleration or deceleration:
+            self.ramp = RampEngine(self.pwm, [self.left_motor, self.right_motor])
+            if pwm_thread:
+                self.ramp.start()
         self.camera = ServoMotor(self.pwm, 12)
+        self.pwm.set_priority([12, 13, 14], AUX)
+        self.pwm.set_deadline(AUX, AUX_DEADLINE)
         self.steering = Steering(
             mount_height=46.1,
             mount_width=40.0,
@@ -115,12 +227,53 @@ class Car:
             width=123,
             length=193.650
         )
+        self._profiles = [CompiledProfile(profile, self.steering, SERVO_0, SERVO_180, steering_table)
+                          for profile in PROFILES]
         self._mode_button = Button(24)
         self._mode_button.when_pressed = self._on_mode_button
         self._mode_led_1 = LED(22)
         self._mode_led_2 = LED(10)
         self.mode = 1
+        self.profile = self._profiles[self.mode]
         self._update_mode()
+        self.failsafe = None
+        self._failsafe_pad = None
+        if failsafe_timeout:
+            self.failsafe = Failsafe(self.on_failsafe, failsafe_timeout)
+            self.failsafe.start()
+
+    def attach_gamepad(self, pad, control=None):
+        """
+        Attach car handlers to gamepad
+
+        :param pad: gamepad
+        :param control: control loop wrapping handlers, if None outputs are committed once per input frame
+        :return: None
+        """
+        # js and evdev devices are silent while the controls hold still, silence is not a lost link
+        failsafe = self.failsafe if pad.periodic_reports else None
+        if failsafe:
+            self._failsafe_pad = pad
+        axis = control.axis if control else lambda func: func
+        button = control.button if control else lambda func: func
+        input_map = InputMap()
+        input_map.axis(gamepad.AXIS_GAS, axis(self.on_forward), trigger=True, deadzone=TRIGGER_DEADZONE)
+        input_map.axis(gamepad.AXIS_BRAKE, axis(self.on_reverse), trigger=True, deadzone=TRIGGER_DEADZONE)
+        input_map.axis(gamepad.AXIS_X, axis(self.on_steering_wheel), deadzone=STICK_DEADZONE)
+        input_map.axis(gamepad.AXIS_Z, axis(self.on_camera_rotate), deadzone=STICK_DEADZONE)
+        input_map.axis(gamepad.AXIS_HAT0Y, axis(self.on_light))
+        input_map.button(gamepad.BTN_B, button(self.on_brake))
+        input_map.attach(pad)
+        if not control:
+            self.pwm.auto_flush = False
+
+        def on_frame(timestamp):
+            if failsafe:
+                failsafe.feed()
+            if not control:
+                self.pwm.commit()
+
+        pad.attach_frame(on_frame)
 
     def _update_mode(self):
         if self.mode & 0x1:
@@ -136,6 +289,8 @@ class Car:
         self.mode += 1
         if self.mode > 3:
             self.mode = 0
+        # handlers read the reference once, so the swap needs no locking
+        self.profile = self._profiles[self.mode]
         self._update_mode()
 
     def on_camera_rotate(self, value, min_value, max_value):
@@ -147,8 +302,7 @@ class Car:
         :param max_value: maximum value for camera position
         :return: None
         """
-        angle = map_range(value, min_value, max_value, MIN_CAMERA_ANGLE, MAX_CAMERA_ANGLE)
-        self.camera.set_angle(angle)
+        self.camera.set_value(self.profile.camera(value, min_value, max_value))
 
     def on_steering_wheel(self, value, min_value, max_value):
         """
@@ -159,19 +313,21 @@ class Car:
         :param max_value: maximum value for steering wheel position
         :return: None
         """
-        angle = map_range(value, min_value, max_value, MIN_ANGLE, MAX_ANGLE)
-        left_angle, right_angle, left_radius, right_radius = self.steering.get_servo_angles(angle)
-        self.steering_wheel_left.set_angle(90 - left_angle)
-        self.steering_wheel_right.set_angle(90 - right_angle)
-        if left_radius < 0 or right_radius < 0 or right_radius == left_radius:
-            self.left_motor.set_differential(1)
-            self.right_motor.set_differential(1)
-        elif left_radius < right_radius:
-            self.right_motor.set_differential(1)
-            self.left_motor.set_differential(left_radius / right_radius)
-        elif left_radius > right_radius:
-            self.right_motor.set_differential(1)
-            self.left_motor.set_differential(right_radius / left_radius)
+        profile = self.profile
+        with self.pwm.transaction():
+            if profile.steering_table:
+                left_value, right_value, left_diff, right_diff = profile.steering_table.lookup(
+                    value, min_value, max_value)
+                self.steering_wheel_left.set_value(left_value)
+                self.steering_wheel_right.set_value(right_value)
+            else:
+                angle = map_range(value, min_value, max_value, profile.min_angle, profile.max_angle)
+                left_angle, right_angle, left_radius, right_radius = self.steering.get_servo_angles(angle)
+                self.steering_wheel_left.set_angle(90 - left_angle)
+                self.steering_wheel_right.set_angle(90 - right_angle)
+                left_diff, right_diff = calc_differential(left_radius, right_radius)
+            self.right_motor.set_differential(right_diff)
+            self.left_motor.set_differential(left_diff)
 
     def on_forward(self, value, min_value, max_value):
         """
@@ -182,8 +338,10 @@ class Car:
         :param max_value: maximum value for forward controller position
         :return: None
         """
-        self.left_motor.forward(value, min_value, max_value)
-        self.right_motor.forward(value, min_value, max_value)
+        speed = self.profile.throttle(value, min_value, max_value)
+        with self.pwm.transaction():
+            self.left_motor.set_forward(speed)
+            self.right_motor.set_forward(speed)
 
     def on_reverse(self, value, min_value, max_value):
         """
@@ -194,8 +352,10 @@ class Car:
         :param max_value: maximum value for reverse controller position
         :return: None
         """
-        self.left_motor.reverse(value, min_value, max_value)
-        self.right_motor.reverse(value, min_value, max_value)
+        speed = self.profile.throttle(value, min_value, max_value)
+        with self.pwm.transaction():
+            self.left_motor.set_reverse(speed)
+            self.right_motor.set_reverse(speed)
 
     def on_brake(self, value):
         """
@@ -204,8 +364,9 @@ class Car:
         :param value: True - key is down, False - key is up
         :return: None
         """
-        self.left_motor.brake(value)
-        self.right_motor.brake(value)
+        with self.pwm.transaction():
+            self.left_motor.brake(value)
+            self.right_motor.brake(value)
 
     def on_light(self, value, min_value, max_value):
         """
@@ -227,18 +388,40 @@ class Car:
                 changed = True
         if changed:
             level = int(map_range(self.light_level, 0, 5, 0, 4095))
-            self.pwm.set_pwm(13, 0, level)
-            self.pwm.set_pwm(14, 0, level)
+            with self.pwm.transaction():
+                self.pwm.set_pwm(13, 0, level)
+                self.pwm.set_pwm(14, 0, level)
 
     def _init_wheels(self):
-        # Move wheel to center
-        self.steering_wheel_left.set_angle(90)
-        self.steering_wheel_right.set_angle(90)
-        # Stop DC motors
-        self.left_motor.stop()
-        self.right_motor.stop()
-        self.right_motor.set_differential(1)
-        self.left_motor.set_differential(1)
+        with self.pwm.transaction():
+            # Move wheel to center
+            self.steering_wheel_left.set_angle(90)
+            self.steering_wheel_right.set_angle(90)
+            # Stop DC motors
+            self.left_motor.stop()
+            self.right_motor.stop()
+            self.right_motor.set_differential(1)
+            self.left_motor.set_differential(1)
+        self.pwm.commit()
+
+    def on_failsafe(self):
+        """
+        Call on input silence.
+        Center steering and stop motors with SAFETY priority, bypassing motor ramp.
+        Returns when the values are written.
+        The gamepad feeding the failsafe dispatches the held controls again with its next report.
+
+        :return: None
+        """
+        with self.pwm.transaction():
+            self.steering_wheel_left.set_angle(90, SAFETY)
+            self.steering_wheel_right.set_angle(90, SAFETY)
+            self.left_motor.stop()
+            self.right_motor.stop()
+        self.pwm.flush()
+        # handlers skip unchanged values, the held controls must be dispatched again when the link recovers
+        if self._failsafe_pad:
+            self._failsafe_pad.invalidate()
 
     def on_disconnected(self):
         """
@@ -259,7 +442,14 @@ class Car:
         self._init_wheels()
 
     def close(self):
+        if self.failsafe:
+            self.failsafe.stop()
+        if self.ramp:
+            self.ramp.stop()
         self.pwm.stop()
+        self._mode_button.close()
+        self._mode_led_1.close()
+        self._mode_led_2.close()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,63 @@
+import os
+
+
+def _env_bool(name, default):
+    value = os.environ.get(name)
+    if value is None:
+        return default
+    return value.lower() in ('1', 'true', 'yes', 'on')
+
+
+def _env_float(name, default):
+    return float(os.environ.get(name, default))
+
+
+STEERING_TABLE = _env_bool('CAR_STEERING_TABLE', True)
+""" Use precomputed steering lookup table """
+BATCHED_PWM = _env_bool('CAR_BATCHED_PWM', True)
+""" Write PWM channels with batched I2C transactions """
+CONTROL_LOOP = _env_bool('CAR_CONTROL_LOOP', False)
+""" Coalesce input events and update outputs once per PWM period """
+ASYNCIO = _env_bool('CAR_ASYNCIO', False)
+""" Run gamepad input, reconnection and PWM flush in one asyncio event loop """
+INPUT_BACKEND = os.environ.get('CAR_INPUT_BACKEND', 'js')
+""" Gamepad input backend: js - joystick API (/dev/input/jsX), evdev - event API (/dev/input/eventX),
+udp - state packets from udp_pad.py sender """
+TRACE = _env_bool('CAR_TRACE', False)
+""" Collect input to PWM latency histograms, dumped on SIGUSR1 """
+HARDWARE = os.environ.get('CAR_HARDWARE', 'pi')
+""" Hardware backend: pi - real PCA9685 and GPIO, mock - in-memory PCA9685 and gpiozero mock pins """
+MOCK_I2C_LATENCY = _env_float('CAR_MOCK_I2C_LATENCY', 0.0)
+""" Simulated duration of I2C transaction for mock hardware (seconds) """
+MOCK_I2C_ERROR_RATE = _env_float('CAR_MOCK_I2C_ERROR_RATE', 0.0)
+""" Simulated probability of I2C transaction failure for mock hardware """
+RECORD = os.environ.get('CAR_RECORD')
+""" Session log file for input events and PWM commands, None to disable recording """
+GAMEPAD_ADDRESS = os.environ.get('CAR_GAMEPAD_ADDRESS', '5C:BA:37:86:31:97')
+""" Bluetooth MAC address of the gamepad """
+BLUETOOTH_ADAPTER = os.environ.get('CAR_BLUETOOTH_ADAPTER', 'hci0')
+""" Bluetooth adapter used to connect the gamepad """
+PWM_ADDRESSES = tuple(int(address, 0) for address in os.environ.get('CAR_PWM_ADDRESSES', '0x40').split(','))
+""" I2C addresses of PCA9685 boards sharing the bus """
+MOTOR_ACCELERATION = _env_float('CAR_MOTOR_ACCELERATION', 4.0)
+""" Motor acceleration limit (full throttle per second), 0 - no limit """
+MOTOR_DECELERATION = _env_float('CAR_MOTOR_DECELERATION', 8.0)
+""" Motor deceleration limit (full throttle per second), 0 - no limit """
+METRICS = os.environ.get('CAR_METRICS')
+""" Metrics endpoint: 'host:port' or Unix socket path, None to disable """
+MULTIPROCESS = _env_bool('CAR_MULTIPROCESS', False)
+""" Write PWM from a separate process sharing the channel table in shared memory """
+REALTIME = _env_bool('CAR_REALTIME', False)
+""" Run PWM, control and input threads with SCHED_FIFO priorities and lock memory """
+REALTIME_PRIORITY = int(os.environ.get('CAR_REALTIME_PRIORITY', 50))
+""" SCHED_FIFO priority of PWM writer, control and input threads get lower priorities """
+REALTIME_CPUS = {int(cpu) for cpu in os.environ['CAR_REALTIME_CPUS'].split(',')} \
+    if os.environ.get('CAR_REALTIME_CPUS') else None
+""" CPUs for real-time threads, None - don't pin """
+FAILSAFE_TIMEOUT = _env_float('CAR_FAILSAFE_TIMEOUT', 1.0)
+""" Stop the car when the udp sender is silent for this time (seconds), 0 - disabled.
+js and evdev devices send nothing while the controls hold still, their link loss is detected by Bluetooth """
+UDP_ADDRESS = os.environ.get('CAR_UDP_ADDRESS', '127.0.0.1:7000')
+""" Listen address of udp input backend, other than loopback requires UDP_KEY """
+UDP_KEY = os.environ.get('CAR_UDP_KEY', '').encode()
+""" Key shared with udp_pad.py sender, packets are signed with HMAC-SHA256 """
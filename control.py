@@ -0,0 +1,243 @@
+import asyncio
+import threading
+import time
+import latency
+import realtime
+from pwm_manager import PWM
+
+
+class PeriodicThread(threading.Thread):
+    """
+    Thread calling tick() at fixed rate. The same loop can run in asyncio event loop with run_async().
+    """
+
+    def __init__(self, name, period, role='control'):
+        """
+        :param name: thread name
+        :param period: tick period (seconds)
+        :param role: realtime role of the thread
+        """
+        super().__init__(name=name, daemon=True)
+        self._period = period
+        self._role = role
+        self._is_stopped = threading.Event()
+
+    def tick(self):
+        """
+        Called once per period
+
+        :return: None
+        """
+        raise NotImplementedError
+
+    def run(self) -> None:
+        realtime.apply(self._role)
+        next_time = time.monotonic()
+        while not self._is_stopped.is_set():
+            next_time += self._period
+            delay = next_time - time.monotonic()
+            if delay > 0:
+                self._is_stopped.wait(delay)
+            else:
+                # overrun, don't try to catch up
+                next_time = time.monotonic()
+            self.tick()
+
+    async def run_async(self):
+        """
+        Run the loop in asyncio event loop instead of thread
+
+        :return: None
+        """
+        loop = asyncio.get_running_loop()
+        next_time = loop.time()
+        while True:
+            next_time = max(next_time + self._period, loop.time())
+            await asyncio.sleep(next_time - loop.time())
+            self.tick()
+
+    def stop(self):
+        self._is_stopped.set()
+        if self.is_alive():
+            self.join()
+
+
+class ControlLoop(PeriodicThread):
+    """
+    Fixed-rate control loop.
+
+    Wrapped input handlers only store the latest value. Once per PWM period the loop calls
+    the real handlers with the latest values and commits the result to PWM as one frame.
+    """
+
+    def __init__(self, pwm: PWM, frequency=None):
+        """
+        :param pwm: PWM manager, switched to commit mode
+        :param frequency: loop frequency (Hz), PWM refresh frequency by default
+        """
+        super().__init__('control', 1.0 / (frequency or pwm.frequency))
+        self._pwm = pwm
+        self._pwm.auto_flush = False
+        self._lock = threading.Lock()
+        self._axes = {}
+        self._buttons = {}
+
+    def axis(self, func):
+        """
+        Wrap axis handler
+
+        :param func: handler func(value, min_value, max_value)
+        :return: handler storing the latest value
+        """
+        def handler(value, min_value, max_value):
+            with self._lock:
+                self._axes[func] = (value, min_value, max_value)
+        return handler
+
+    def button(self, func):
+        """
+        Wrap button handler
+
+        :param func: handler func(value)
+        :return: handler storing the latest value
+        """
+        def handler(value):
+            with self._lock:
+                self._buttons[func] = value
+        return handler
+
+    def tick(self):
+        """
+        Apply the latest input state and commit outputs
+
+        :return: None
+        """
+        with self._lock:
+            axes, self._axes = self._axes, {}
+            buttons, self._buttons = self._buttons, {}
+        with self._pwm.transaction():
+            for func, value in buttons.items():
+                func(value)
+            for func, args in axes.items():
+                func(*args)
+        self._pwm.commit()
+
+
+class RampEngine(PeriodicThread):
+    """
+    Motor ramp engine. Once per PWM period moves duty of ramped motors toward their targets,
+    so motor outputs are written at most once per period whatever the input rate.
+    """
+
+    def __init__(self, pwm: PWM, motors, frequency=None):
+        """
+        :param pwm: PWM manager
+        :param motors: list of motors with step(period) method
+        :param frequency: ramp frequency (Hz), PWM refresh frequency by default
+        """
+        super().__init__('ramp', 1.0 / (frequency or pwm.frequency))
+        self._pwm = pwm
+        self._motors = motors
+
+    def tick(self):
+        """
+        Make one ramp step and commit changed outputs
+
+        :return: None
+        """
+        changed = False
+        with self._pwm.transaction():
+            for motor in self._motors:
+                changed = motor.step(self._period) or changed
+        if changed:
+            self._pwm.commit()
+
+
+class Failsafe(threading.Thread):
+    """
+    Dead-man timer. When no input frame arrives for the timeout, the failsafe action is called
+    from this thread, so the reaction doesn't depend on the input thread waking up.
+    The timer is armed again by the next input frame.
+    Only input sources sending state periodically while the controls hold still may feed the timer.
+    """
+
+    def __init__(self, action, timeout):
+        """
+        :param action: func() bringing the car to the safe state
+        :param timeout: allowed input silence (seconds)
+        """
+        super().__init__(name='failsafe', daemon=True)
+        self._action = action
+        self.timeout = timeout
+        self._last = time.monotonic()
+        self._armed = False
+        self._lock = threading.Lock()
+        self._is_stopped = threading.Event()
+        self.trips = 0
+        self.reaction = latency.Histogram()
+        """ Delay from the timeout expiry to the end of the failsafe action,
+        the action returns when outputs are written (microseconds) """
+
+    def feed(self):
+        """
+        Report fresh input
+
+        :return: None
+        """
+        with self._lock:
+            self._last = time.monotonic()
+            self._armed = True
+
+    def _expired(self):
+        """
+        Disarm the timer if input is silent for the timeout. Must be called with locked _lock.
+
+        :return: deadline if the timer is expired, otherwise None
+        """
+        deadline = self._last + self.timeout
+        if not self._armed or time.monotonic() < deadline:
+            return None
+        self._armed = False
+        return deadline
+
+    def run(self) -> None:
+        realtime.apply('failsafe')
+        while not self._is_stopped.is_set():
+            with self._lock:
+                armed = self._armed
+                deadline = self._last + self.timeout
+            if not armed:
+                self._is_stopped.wait(self.timeout)
+                continue
+            delay = deadline - time.monotonic()
+            if delay > 0:
+                self._is_stopped.wait(delay)
+                continue
+            with self._lock:
+                # input may have arrived after the deadline was read
+                deadline = self._expired()
+            if deadline is None:
+                continue
+            self._action()
+            reaction = time.monotonic() - deadline
+            self.trips += 1
+            self.reaction.add(int(reaction * 1000000))
+            print("Failsafe: no input for {:.3f} s, reaction {:.1f} ms".format(
+                self.timeout, reaction * 1000))
+
+    def metrics(self):
+        """
+        Metrics source, see metrics.Metrics.add_source
+
+        :return: list of (name, type, help, value)
+        """
+        return [
+            ('car_failsafe_trips_total', 'counter', "Failsafe activations", self.trips),
+            ('car_failsafe_reaction_p99_seconds', 'gauge', "99th percentile of failsafe reaction time",
+             self.reaction.percentile(99) / 1000000),
+        ]
+
+    def stop(self):
+        self._is_stopped.set()
+        if self.is_alive():
+            self.join()
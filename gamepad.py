@@ -1,5 +1,11 @@
+import asyncio
+import latency
+import metrics
 import os
+import recorder
+import select
 import struct
+import time
 import array
 from fcntl import ioctl
 
@@ -69,6 +75,25 @@ BTN_DPAD_RIGHT_XB360 = 0x2c1
 BTN_DPAD_UP_XB360 = 0x2c2
 BTN_DPAD_DOWN_XB360 = 0x2c3
 
+JS_EVENT = struct.Struct('IhBB')
+""" Joystick event: time (ms), value, type, number """
+JS_EVENT_BUTTON = 0x01
+JS_EVENT_AXIS = 0x02
+JS_EVENT_INIT = 0x80
+READ_EVENTS = 64
+""" Maximum number of events read by one system call """
+
+INPUT_EVENT = struct.Struct('llHHi')
+""" evdev input_event: time (sec, usec), type, code, value """
+EV_SYN = 0x00
+EV_KEY = 0x01
+EV_ABS = 0x03
+SYN_REPORT = 0x00
+SYN_DROPPED = 0x03
+ABS_CNT = 0x40
+KEY_CNT = 0x300
+BTN_GAMEPAD = BTN_A
+
 
 class GamePad:
 
@@ -76,12 +101,29 @@ class GamePad:
         self.axis_map = []
         self.buttons_map = []
         self.jsdev = None
+        self.periodic_reports = False
+        """ Device sends state periodically while the controls hold still, so silence means lost link """
         self.attached_axis = {}
         self.attached_buttons = {}
+        self.axis_shapes = {}
+        self.attached_frame = None
+        self._buffer = bytearray(JS_EVENT.size * READ_EVENTS)
+        self._axis_values = []
+        self._axis_dirty = []
+        self._compiled = False
+        self._axis_handlers = []
+        self._axis_tables = []
+        self._axis_offsets = []
+        self._axis_ranges = []
+        self._axis_last = []
+        self._button_handlers = []
+        self._invalidated = False
 
     def open(self, dev="/dev/input/js0"):
         print('Opening %s...' % dev)
-        self.jsdev = open(dev, 'rb')
+        self.jsdev = os.open(dev, os.O_RDONLY | os.O_NONBLOCK)
+        self.axis_map = []
+        self.buttons_map = []
 
         # Get number of axes and buttons.
         buf = array.array('B', [0])
@@ -106,34 +148,492 @@ class GamePad:
         for btn in buf[:num_buttons]:
             self.buttons_map.append(btn)
 
+        self._axis_values = [0] * num_axes
+        # axes left by a failed process() call of the previous device
+        self._axis_dirty.clear()
+        self._compile()
+        self._record_device()
+
+    def _record_device(self):
+        """
+        Record device maps to session log
+
+        :return: None
+        """
+        rec = recorder.active
+        if rec:
+            timestamp = time.monotonic_ns()
+            for number, axis in enumerate(self.axis_map):
+                rec.record(timestamp, recorder.KIND_JS_AXIS, 0, number, axis)
+            for number, button in enumerate(self.buttons_map):
+                rec.record(timestamp, recorder.KIND_JS_BUTTON, 0, number, button)
+
+    def attach_device(self, fd, axis_map, buttons_map):
+        """
+        Use already opened non-blocking file descriptor with joystick events, e.g. pipe for replay
+
+        :param fd: file descriptor
+        :param axis_map: list of axis ids for axis numbers
+        :param buttons_map: list of button ids for button numbers
+        :return: None
+        """
+        self.jsdev = fd
+        self.axis_map = list(axis_map)
+        self.buttons_map = list(buttons_map)
+        self._axis_values = [0] * len(self.axis_map)
+        self._axis_dirty.clear()
+        self._compile()
+        self._record_device()
+
     def close(self):
-        if self.jsdev:
-            self.jsdev.close()
+        if self.jsdev is not None:
+            os.close(self.jsdev)
             self.jsdev = None
 
-    def attach_axis(self, axis_id: int, func):
+    def fileno(self):
+        return self.jsdev
+
+    def attach_axis(self, axis_id: int, func, shape=None):
+        """
+        Attach axis handler
+
+        :param axis_id: axis id
+        :param func: handler func(value, min_value, max_value)
+        :param shape: input_map.Shape applied to raw values, None - dispatch raw values
+        :return: None
+        """
         self.attached_axis[axis_id] = func
+        self.axis_shapes[axis_id] = shape
+        self._compiled = False
 
     def attach_button(self, btn_id: int, func):
         self.attached_buttons[btn_id] = func
+        self._compiled = False
 
-    def loop(self):
-        while True:
-            ev_buf = self.jsdev.read(8)
-            if ev_buf:
-                time, value, ev_type, number = struct.unpack('IhBB', ev_buf)
+    def _axis_range(self, axis):
+        """
+        :return: tuple (minimum, maximum) of raw axis values
+        """
+        return -32767, 32767
+
+    def _compile(self):
+        """
+        Build flat dispatch arrays indexed by device axis and button numbers and axis lookup tables
+
+        :return: None
+        """
+        self._compile_maps(self.axis_map, self.buttons_map)
+
+    def _compile_maps(self, axis_map, buttons_map):
+        """
+        :param axis_map: axis ids for array indexes
+        :param buttons_map: button ids for array indexes
+        :return: None
+        """
+        self._axis_handlers = []
+        self._axis_tables = []
+        self._axis_offsets = []
+        self._axis_ranges = []
+        for axis in axis_map:
+            self._compile_axis(axis)
+        self._axis_last = [None] * len(self._axis_handlers)
+        self._button_handlers = [self.attached_buttons.get(button, None) for button in buttons_map]
+        self._compiled = True
+
+    def _compile_axis(self, axis):
+        func = self.attached_axis.get(axis, None)
+        shape = self.axis_shapes.get(axis, None)
+        in_min, in_max = self._axis_range(axis)
+        self._axis_handlers.append(func)
+        if func and shape:
+            self._axis_tables.append(shape.table(in_min, in_max))
+            self._axis_offsets.append(in_min)
+            self._axis_ranges.append(shape.range)
+        else:
+            self._axis_tables.append(None)
+            self._axis_offsets.append(0)
+            self._axis_ranges.append((in_min, in_max))
 
-                if ev_type & 0x80:
+    def _dispatch_axis(self, number, value):
+        """
+        Dispatch axis value through compiled arrays.
+        Shaped value equal to the last dispatched one is not dispatched.
+
+        :param number: index in compiled arrays
+        :param value: raw value
+        :return: True if handler is called
+        """
+        fnc = self._axis_handlers[number]
+        if not fnc:
+            return False
+        table = self._axis_tables[number]
+        if table is not None:
+            index = value - self._axis_offsets[number]
+            if index < 0:
+                index = 0
+            elif index >= len(table):
+                index = len(table) - 1
+            value = table[index]
+            if value == self._axis_last[number]:
+                return False
+            self._axis_last[number] = value
+        if latency.tracer:
+            latency.tracer.dispatch()
+        min_value, max_value = self._axis_ranges[number]
+        fnc(value, min_value, max_value)
+        return True
+
+    def invalidate(self):
+        """
+        Forget dispatched state after the outputs were changed behind the handlers, e.g. by failsafe.
+        The state is reset by the input thread before the next frame. Devices with periodic reports
+        dispatch full state of the controls again, other devices dispatch values of moved controls.
+
+        :return: None
+        """
+        self._invalidated = True
+
+    def _forget(self):
+        """
+        Reset dispatched state requested by invalidate()
+
+        :return: None
+        """
+        self._invalidated = False
+        self._axis_last = [None] * len(self._axis_last)
+
+    def attach_frame(self, func):
+        """
+        Attach handler called after all events of one frame are dispatched
+
+        :param func: handler func(timestamp), timestamp of the frame in seconds
+        :return: None
+        """
+        self.attached_frame = func
+
+    def process(self):
+        """
+        Read all pending events and dispatch them.
+        Button events are dispatched in order, for every axis only the newest value is dispatched.
+
+        :return: None
+        """
+        view = memoryview(self._buffer)
+        tracer = latency.tracer
+        rec = recorder.active
+        counters = metrics.active.counters() if metrics.active else None
+        if not self._compiled:
+            self._compile()
+        if self._invalidated:
+            self._forget()
+        timestamp = None
+        while True:
+            try:
+                size = os.readv(self.jsdev, [self._buffer])
+            except BlockingIOError:
+                break
+            if not size:
+                raise EOFError("Joystick device is closed")
+            if tracer:
+                tracer.read()
+            if rec:
+                read_time = time.monotonic_ns()
+            for ev_time, value, ev_type, number in JS_EVENT.iter_unpack(view[:size]):
+                if rec:
+                    rec.record(read_time, recorder.KIND_JS_EVENT, ev_type, number, value, ev_time)
+                if ev_type & JS_EVENT_INIT:
                     continue
+                timestamp = ev_time
 
-                if ev_type & 0x01:
-                    button = self.buttons_map[number]
-                    fnc = self.attached_buttons.get(button, None)
+                if ev_type & JS_EVENT_BUTTON:
+                    fnc = self._button_handlers[number]
+                    if counters:
+                        counters.inc(('car_input_events_total', 'button', self.buttons_map[number]))
                     if fnc:
+                        if tracer:
+                            tracer.dispatch()
+                        if counters:
+                            counters.inc(('car_handler_calls_total', 'button', self.buttons_map[number]))
                         fnc(value)
 
-                if ev_type & 0x02:
-                    axis = self.axis_map[number]
-                    fnc = self.attached_axis.get(axis, None)
-                    if fnc:
-                        fnc(value, -32767, 32767)
+                if ev_type & JS_EVENT_AXIS:
+                    if counters:
+                        counters.inc(('car_input_events_total', 'axis', self.axis_map[number]))
+                    if number not in self._axis_dirty:
+                        self._axis_dirty.append(number)
+                    self._axis_values[number] = value
+            if size < len(self._buffer):
+                break
+
+        for number in self._axis_dirty:
+            if self._dispatch_axis(number, self._axis_values[number]) and counters:
+                counters.inc(('car_handler_calls_total', 'axis', self.axis_map[number]))
+        self._axis_dirty.clear()
+        if timestamp is not None and self.attached_frame:
+            self.attached_frame(timestamp / 1000)
+
+    def loop(self):
+        poller = select.poll()
+        poller.register(self.jsdev, select.POLLIN)
+        while True:
+            poller.poll()
+            self.process()
+
+
+class EvdevGamePad(GamePad):
+    """
+    GamePad reading evdev device (/dev/input/eventX).
+    Events between SYN_REPORT markers are dispatched as one frame.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self._buffer = bytearray(INPUT_EVENT.size * READ_EVENTS)
+        self._abs_range = {}
+        self._axis_values = {}
+        self._frame_buttons = []
+        self._pressed = set()
+        self._dropped = False
+        self.replay_state = None
+        """ Device state recorded by resync, used instead of ioctls when replaying.
+        Dictionary (EV_ABS or EV_KEY, code) -> value, None for real devices """
+
+    def open(self, dev="/dev/input/event0"):
+        print('Opening %s...' % dev)
+        self.jsdev = os.open(dev, os.O_RDONLY | os.O_NONBLOCK)
+
+        # Check that device is a gamepad.
+        buf = array.array('B', [0] * (KEY_CNT // 8))
+        ioctl(self.jsdev, 0x80004520 + EV_KEY + (len(buf) << 16), buf)  # EVIOCGBIT(EV_KEY)
+        if not buf[BTN_GAMEPAD // 8] & (1 << (BTN_GAMEPAD % 8)):
+            raise OSError("{} is not a gamepad".format(dev))
+
+        # Get ranges of absolute axes.
+        buf = array.array('B', [0] * (ABS_CNT // 8))
+        ioctl(self.jsdev, 0x80004520 + EV_ABS + (len(buf) << 16), buf)  # EVIOCGBIT(EV_ABS)
+        self._abs_range = {}
+        for axis in range(0, ABS_CNT):
+            if buf[axis // 8] & (1 << (axis % 8)):
+                info = self._abs_info(axis)
+                self._abs_range[axis] = (info[1], info[2])
+        self._axis_values = {}
+        self._frame_buttons = []
+        self._pressed = set()
+        self._dropped = False
+        self.replay_state = None
+        self._compile()
+        self._record_device()
+
+    def attach_device(self, fd, abs_range):
+        """
+        Use already opened non-blocking file descriptor with evdev events, e.g. pipe for replay
+
+        :param fd: file descriptor
+        :param abs_range: dictionary axis code -> (minimum, maximum)
+        :return: None
+        """
+        self.jsdev = fd
+        self._abs_range = dict(abs_range)
+        self._axis_values = {}
+        self._frame_buttons = []
+        self._pressed = set()
+        self._dropped = False
+        # the descriptor doesn't support ioctls, resync uses replay_state
+        self.replay_state = {}
+        self._compile()
+        self._record_device()
+
+    def _axis_range(self, axis):
+        return self._abs_range.get(axis, (-32767, 32767))
+
+    def _compile(self):
+        """
+        Build flat dispatch arrays indexed by axis and key codes and axis lookup tables
+
+        :return: None
+        """
+        self._compile_maps(range(0, ABS_CNT), range(0, KEY_CNT))
+
+    def _record_device(self):
+        rec = recorder.active
+        if rec:
+            timestamp = time.monotonic_ns()
+            for axis, (min_value, max_value) in self._abs_range.items():
+                rec.record(timestamp, recorder.KIND_EVDEV_ABS, 0, axis, min_value, 0, max_value)
+
+    def _abs_info(self, axis):
+        """
+        Get axis state
+
+        :param axis: axis code
+        :return: input_absinfo (value, minimum, maximum, fuzz, flat, resolution)
+        """
+        info = array.array('i', [0] * 6)
+        ioctl(self.jsdev, 0x80184540 + axis, info)  # EVIOCGABS(axis)
+        return info
+
+    def _key_state(self):
+        """
+        Get state of all keys
+
+        :return: bit array of pressed keys indexed by key code
+        """
+        buf = array.array('B', [0] * (KEY_CNT // 8))
+        ioctl(self.jsdev, 0x80004518 + (len(buf) << 16), buf)  # EVIOCGKEY
+        return buf
+
+    def process(self):
+        """
+        Read all pending events and dispatch complete frames.
+        Button events are dispatched in order, for every axis only the newest value of the frame is dispatched.
+
+        :return: None
+        """
+        view = memoryview(self._buffer)
+        if not self._compiled:
+            self._compile()
+        if self._invalidated:
+            self._forget()
+        while True:
+            try:
+                size = os.readv(self.jsdev, [self._buffer])
+            except BlockingIOError:
+                break
+            if not size:
+                raise EOFError("Input device is closed")
+            if latency.tracer:
+                latency.tracer.read()
+            rec = recorder.active
+            if rec:
+                read_time = time.monotonic_ns()
+            counters = metrics.active.counters() if metrics.active else None
+            for sec, usec, ev_type, code, value in INPUT_EVENT.iter_unpack(view[:size]):
+                if rec:
+                    rec.record(read_time, recorder.KIND_EVDEV_EVENT, ev_type, code, value, sec, usec)
+                if ev_type == EV_SYN:
+                    if code == SYN_REPORT:
+                        if self._dropped:
+                            self._resync()
+                        self._dispatch(sec + usec / 1000000)
+                    elif code == SYN_DROPPED:
+                        # kernel buffer overrun, ignore events up to the next SYN_REPORT
+                        self._dropped = True
+                        self._frame_buttons.clear()
+                        self._axis_values.clear()
+                elif self._dropped:
+                    continue
+                elif ev_type == EV_KEY:
+                    if counters:
+                        counters.inc(('car_input_events_total', 'button', code))
+                    self._frame_buttons.append((code, value))
+                elif ev_type == EV_ABS:
+                    if counters:
+                        counters.inc(('car_input_events_total', 'axis', code))
+                    self._axis_values[code] = value
+            if size < len(self._buffer):
+                break
+
+    def _read_state(self):
+        """
+        Read actual state of attached axes and buttons
+
+        :return: dictionary (EV_ABS or EV_KEY, code) -> value
+        """
+        state = {}
+        for axis in self.attached_axis:
+            if axis in self._abs_range:
+                state[(EV_ABS, axis)] = self._abs_info(axis)[0]
+        keys = self._key_state()
+        for button in self.attached_buttons:
+            if button < KEY_CNT:
+                state[(EV_KEY, button)] = keys[button // 8] >> (button % 8) & 1
+        return state
+
+    def _resync(self):
+        """
+        Restore actual state of attached axes and buttons after dropped events.
+        Buttons pressed or released during the overrun are dispatched with the frame.
+
+        :return: None
+        """
+        self._dropped = False
+        if self.replay_state is None:
+            state = self._read_state()
+        else:
+            state = dict(self.replay_state)
+            self.replay_state.clear()
+        rec = recorder.active
+        if rec:
+            timestamp = time.monotonic_ns()
+            for (ev_type, code), value in state.items():
+                rec.record(timestamp, recorder.KIND_EVDEV_STATE, ev_type, code, value)
+        for (ev_type, code), value in state.items():
+            if ev_type == EV_ABS:
+                self._axis_values[code] = value
+            elif value != (code in self._pressed):
+                self._frame_buttons.append((code, value))
+
+    def _dispatch(self, timestamp):
+        """
+        Dispatch collected frame
+
+        :param timestamp: frame time in seconds
+        :return: None
+        """
+        tracer = latency.tracer
+        counters = metrics.active.counters() if metrics.active else None
+        if tracer:
+            tracer.event(timestamp)
+        for button, value in self._frame_buttons:
+            if value:
+                self._pressed.add(button)
+            else:
+                self._pressed.discard(button)
+            fnc = self._button_handlers[button] if button < KEY_CNT else None
+            if fnc:
+                if tracer:
+                    tracer.dispatch()
+                if counters:
+                    counters.inc(('car_handler_calls_total', 'button', button))
+                fnc(value)
+        for axis, value in self._axis_values.items():
+            if axis < ABS_CNT and self._dispatch_axis(axis, value) and counters:
+                counters.inc(('car_handler_calls_total', 'axis', axis))
+        self._frame_buttons.clear()
+        self._axis_values.clear()
+        if self.attached_frame:
+            self.attached_frame(timestamp)
+
+
+class AsyncGamePad(GamePad):
+    """
+    GamePad for asyncio event loop. Events are read when the device becomes readable.
+    """
+
+    async def run(self):
+        """
+        Dispatch events until the device is disconnected
+
+        :return: None
+        """
+        loop = asyncio.get_running_loop()
+        done = loop.create_future()
+
+        def on_readable():
+            try:
+                self.process()
+            except Exception as err:
+                if not done.done():
+                    done.set_exception(err)
+
+        loop.add_reader(self.jsdev, on_readable)
+        try:
+            await done
+        finally:
+            loop.remove_reader(self.jsdev)
+
+
+class AsyncEvdevGamePad(EvdevGamePad, AsyncGamePad):
+    """
+    EvdevGamePad for asyncio event loop.
+    """
@@ -0,0 +1,153 @@
+import errno
+import random
+import threading
+import time
+import config
+
+if config.HARDWARE == 'mock':
+    from gpiozero import Device
+    from gpiozero.pins.mock import MockFactory
+    Device.pin_factory = MockFactory()
+
+from gpiozero import LED, Button
+
+PCA9685_ADDRESS = 0x40
+""" Default I2C address of PCA9685 """
+
+MODE1 = 0x00
+""" PCA9685 MODE1 register """
+MODE1_AI = 0x20
+""" MODE1 register auto-increment bit """
+LED0_ON_L = 0x06
+""" First register of channel 0 """
+ALL_LED_ON_L = 0xFA
+""" First register of all channels """
+PRESCALE = 0xFE
+""" PWM frequency prescaler register """
+
+
+class MockI2CDevice:
+    """
+    In-memory I2C device with 256 byte registers.
+    Every transaction is recorded with its timestamp, latency and errors can be simulated.
+    """
+
+    def __init__(self, address, latency=0.0, error_rate=0.0):
+        """
+        :param address: I2C address
+        :param latency: duration of every transaction (seconds)
+        :param error_rate: probability of transaction failure (0..1)
+        """
+        self.address = address
+        self.latency = latency
+        self.error_rate = error_rate
+        self.fail_count = 0
+        """ Number of next transactions to fail """
+        self.registers = bytearray(256)
+        self.transactions = []
+        """ List of (timestamp, register, data) for every successful write transaction """
+        self._lock = threading.Lock()
+
+    def _transaction(self):
+        if self.latency:
+            time.sleep(self.latency)
+        if self.fail_count > 0:
+            self.fail_count -= 1
+            raise OSError(errno.EIO, "Simulated I2C error")
+        if self.error_rate and random.random() < self.error_rate:
+            raise OSError(errno.EIO, "Simulated I2C error")
+
+    def _store(self, register, data):
+        """
+        Store data to registers.
+        Without auto-increment all bytes go to the same register.
+        """
+        with self._lock:
+            self._transaction()
+            self.transactions.append((time.perf_counter(), register, bytes(data)))
+            auto_increment = self.registers[MODE1] & MODE1_AI
+            for i, value in enumerate(data):
+                self._store_register(register + i if auto_increment else register, value)
+
+    def _store_register(self, register, value):
+        self.registers[register & 0xFF] = value & 0xFF
+
+    def write8(self, register, value):
+        self._store(register, [value])
+
+    def writeList(self, register, data):
+        self._store(register, data)
+
+    def readU8(self, register):
+        with self._lock:
+            self._transaction()
+            return self.registers[register]
+
+    def readList(self, register, length):
+        with self._lock:
+            self._transaction()
+            return bytearray(self.registers[register:register + length])
+
+
+class MockPCA9685Device(MockI2CDevice):
+    """
+    Mock I2C device with PCA9685 ALL_LED registers behaviour
+    """
+
+    def _store_register(self, register, value):
+        super()._store_register(register, value)
+        if ALL_LED_ON_L <= register < ALL_LED_ON_L + 4:
+            offset = register - ALL_LED_ON_L
+            for channel in range(0, 16):
+                self.registers[LED0_ON_L + 4 * channel + offset] = value & 0xFF
+
+
+class MockPCA9685:
+    """
+    In-memory stand-in for Adafruit_PCA9685.PCA9685
+    """
+
+    def __init__(self, address=PCA9685_ADDRESS, latency=0.0, error_rate=0.0):
+        self._device = MockPCA9685Device(address, latency, error_rate)
+        self.set_all_pwm(0, 0)
+
+    def set_pwm_freq(self, freq_hz):
+        prescale = int(25000000.0 / 4096.0 / float(freq_hz) - 1.0 + 0.5)
+        self._device.write8(PRESCALE, prescale)
+
+    def set_pwm(self, channel, on, off):
+        self._device.write8(LED0_ON_L + 4 * channel, on & 0xFF)
+        self._device.write8(LED0_ON_L + 4 * channel + 1, on >> 8)
+        self._device.write8(LED0_ON_L + 4 * channel + 2, off & 0xFF)
+        self._device.write8(LED0_ON_L + 4 * channel + 3, off >> 8)
+
+    def set_all_pwm(self, on, off):
+        self._device.write8(ALL_LED_ON_L, on & 0xFF)
+        self._device.write8(ALL_LED_ON_L + 1, on >> 8)
+        self._device.write8(ALL_LED_ON_L + 2, off & 0xFF)
+        self._device.write8(ALL_LED_ON_L + 3, off >> 8)
+
+    def get_pwm(self, channel):
+        """
+        Get channel value from registers
+
+        :param channel: channel number
+        :return: tuple (on, off)
+        """
+        registers = self._device.registers
+        base = LED0_ON_L + 4 * channel
+        return (registers[base] | registers[base + 1] << 8,
+                registers[base + 2] | registers[base + 3] << 8)
+
+
+def PCA9685(address=PCA9685_ADDRESS):
+    """
+    Create PCA9685 driver for selected hardware backend
+
+    :param address: I2C address
+    :return: Adafruit_PCA9685.PCA9685 or MockPCA9685
+    """
+    if config.HARDWARE == 'mock':
+        return MockPCA9685(address, config.MOCK_I2C_LATENCY, config.MOCK_I2C_ERROR_RATE)
+    import Adafruit_PCA9685
+    return Adafruit_PCA9685.PCA9685(address)
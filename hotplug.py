@@ -0,0 +1,134 @@
+import asyncio
+import ctypes
+import os
+import select
+import struct
+
+INPUT_DIR = "/dev/input"
+""" Directory with input device nodes """
+
+IN_ATTRIB = 0x00000004
+IN_CREATE = 0x00000100
+INOTIFY_EVENT = struct.Struct('iIII')
+""" inotify event header: wd, mask, cookie, len """
+
+_libc = ctypes.CDLL(None, use_errno=True)
+
+
+class HotplugWatcher:
+    """
+    Watch input directory with inotify and report appeared device nodes
+    """
+
+    def __init__(self, directory=INPUT_DIR, prefix="js"):
+        """
+        :param directory: directory with device nodes
+        :param prefix: prefix of device node name, followed by device number
+        """
+        self.directory = directory
+        self.prefix = prefix
+        self._fd = _libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self._fd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+        # IN_ATTRIB is needed because udev sets permissions after the node is created
+        if _libc.inotify_add_watch(self._fd, os.fsencode(directory), IN_CREATE | IN_ATTRIB) < 0:
+            err = ctypes.get_errno()
+            os.close(self._fd)
+            raise OSError(err, os.strerror(err), directory)
+        self._buffer = bytearray(4096)
+
+    def fileno(self):
+        return self._fd
+
+    def close(self):
+        if self._fd >= 0:
+            os.close(self._fd)
+            self._fd = -1
+
+    def _match(self, name):
+        return name.startswith(self.prefix) and name[len(self.prefix):].isdigit()
+
+    def devices(self):
+        """
+        Get existing device nodes
+
+        :return: list of device paths ordered by device number
+        """
+        names = [name for name in os.listdir(self.directory) if self._match(name)]
+        names.sort(key=lambda name: int(name[len(self.prefix):]))
+        return [os.path.join(self.directory, name) for name in names]
+
+    def read(self):
+        """
+        Read all pending inotify events without blocking
+
+        :return: list of device paths created or changed since last read
+        """
+        paths = []
+        while True:
+            try:
+                size = os.readv(self._fd, [self._buffer])
+            except BlockingIOError:
+                return paths
+            pos = 0
+            while pos < size:
+                wd, mask, cookie, length = INOTIFY_EVENT.unpack_from(self._buffer, pos)
+                pos += INOTIFY_EVENT.size
+                name = os.fsdecode(bytes(self._buffer[pos:pos + length]).rstrip(b'\0'))
+                pos += length
+                path = os.path.join(self.directory, name)
+                if self._match(name) and path not in paths:
+                    paths.append(path)
+
+    def wait(self, existing=True, timeout=None):
+        """
+        Wait for device node
+
+        :param existing: return already existing devices without waiting
+        :param timeout: timeout (seconds), None to wait forever
+        :return: list of device paths, empty on timeout
+        """
+        paths = self.read()
+        if existing:
+            devices = self.devices()
+            if devices:
+                return devices
+        if paths:
+            return paths
+        poller = select.poll()
+        poller.register(self._fd, select.POLLIN)
+        while True:
+            if not poller.poll(None if timeout is None else timeout * 1000):
+                return []
+            paths = self.read()
+            if paths:
+                return paths
+
+    async def wait_async(self, existing=True):
+        """
+        Asyncio version of wait()
+
+        :param existing: return already existing devices without waiting
+        :return: list of device paths
+        """
+        paths = self.read()
+        if existing:
+            devices = self.devices()
+            if devices:
+                return devices
+        if paths:
+            return paths
+        loop = asyncio.get_running_loop()
+        done = loop.create_future()
+
+        def on_readable():
+            appeared = self.read()
+            if appeared and not done.done():
+                done.set_result(appeared)
+
+        loop.add_reader(self._fd, on_readable)
+        try:
+            return await done
+        finally:
+            loop.remove_reader(self._fd)
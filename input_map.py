@@ -0,0 +1,132 @@
+"""
+Declarative input mapping.
+
+Axis shape (deadzone, response curve, inversion, output range) is compiled to a lookup table
+indexed by raw device value when the device is opened, so dispatch of an axis event is one table lookup.
+Raw values mapped to the same output (e.g. stick noise inside the deadzone) are not dispatched.
+"""
+import array
+
+_tables = {}
+""" Lookup tables shared by equal shapes: (shape parameters, in_min, in_max) -> table """
+
+
+class Shape:
+    """
+    Axis response shape
+    """
+
+    def __init__(self,
+                 deadzone: float = 0.0,
+                 expo: float = 0.0,
+                 invert: bool = False,
+                 trigger: bool = False,
+                 min_value: int = -32767,
+                 max_value: int = 32767):
+        """
+        :param deadzone: part of travel around the rest position mapped to rest (0..1)
+        :param expo: response curve, 0 - linear, 1 - cubic
+        :param invert: reverse direction
+        :param trigger: axis rests at the minimum position, otherwise at the center
+        :param min_value: output value for the minimum position
+        :param max_value: output value for the maximum position
+        """
+        self.deadzone = deadzone
+        self.expo = expo
+        self.invert = invert
+        self.trigger = trigger
+        self.min_value = min_value
+        self.max_value = max_value
+
+    def position(self, value, in_min, in_max):
+        """
+        Apply shape to raw value
+
+        :param value: raw value
+        :param in_min: minimum raw value
+        :param in_max: maximum raw value
+        :return: shaped position, -1..1 for centered axis, 0..1 for trigger
+        """
+        position = (value - in_min) / (in_max - in_min)
+        position = min(max(position, 0.0), 1.0)
+        if self.invert:
+            position = 1.0 - position
+        if not self.trigger:
+            position = position * 2 - 1
+        magnitude = abs(position)
+        if magnitude <= self.deadzone:
+            return 0.0
+        magnitude = (magnitude - self.deadzone) / (1 - self.deadzone)
+        magnitude = (1 - self.expo) * magnitude + self.expo * magnitude * magnitude * magnitude
+        return magnitude if position > 0 else -magnitude
+
+    def table(self, in_min, in_max):
+        """
+        Get lookup table of output values indexed by raw value - in_min
+
+        :param in_min: minimum raw value
+        :param in_max: maximum raw value
+        :return: array of output values
+        """
+        key = (self.deadzone, self.expo, self.invert, self.trigger, self.min_value, self.max_value, in_min, in_max)
+        table = _tables.get(key)
+        if table is not None:
+            return table
+        low = -1.0 if not self.trigger else 0.0
+        scale = (self.max_value - self.min_value) / (1.0 - low)
+        typecode = 'h' if -32768 <= min(self.min_value, self.max_value) and \
+            max(self.min_value, self.max_value) <= 32767 else 'i'
+        table = array.array(typecode, [
+            int(round((self.position(value, in_min, in_max) - low) * scale + self.min_value))
+            for value in range(in_min, in_max + 1)])
+        _tables[key] = table
+        return table
+
+    @property
+    def range(self):
+        return self.min_value, self.max_value
+
+
+class InputMap:
+    """
+    Bindings of gamepad axes and buttons to handlers
+    """
+
+    def __init__(self):
+        self.axes = []
+        """ List of (axis id, handler, shape) """
+        self.buttons = []
+        """ List of (button id, handler) """
+
+    def axis(self, axis_id, handler, **shape):
+        """
+        Bind axis
+
+        :param axis_id: axis id
+        :param handler: func(value, min_value, max_value)
+        :param shape: Shape arguments, raw values are dispatched if empty
+        :return: None
+        """
+        self.axes.append((axis_id, handler, Shape(**shape) if shape else None))
+
+    def button(self, button_id, handler):
+        """
+        Bind button
+
+        :param button_id: button id
+        :param handler: func(value)
+        :return: None
+        """
+        self.buttons.append((button_id, handler))
+
+    def attach(self, pad):
+        """
+        Attach bindings to gamepad
+
+        :param pad: gamepad
+        :return: None
+        """
+        for axis_id, handler, shape in self.axes:
+            pad.attach_axis(axis_id, handler, shape)
+        for button_id, handler in self.buttons:
+            pad.attach_button(button_id, handler)
@@ -0,0 +1,185 @@
+import threading
+import time
+
+STAGES = ('kernel', 'dispatch', 'queue', 'flush', 'total')
+""" Measured stages:
+kernel - from input event timestamp to read (evdev only),
+dispatch - from read to call of handler,
+queue - from call of handler to PWM.set_pwm,
+flush - from PWM.set_pwm to write to the chip,
+total - from read to write to the chip
+"""
+
+tracer = None
+""" Active tracer, None if tracing is disabled """
+
+
+class Histogram:
+    """
+    Log-scale histogram of durations in microseconds.
+    Every power of two is split to 4 buckets, so the reported percentile is at most 25% above the real value.
+    """
+
+    def __init__(self):
+        self.counts = [0] * 256
+        self.count = 0
+        self.max = 0
+
+    def add(self, value):
+        """
+        Add duration
+
+        :param value: duration (microseconds)
+        :return: None
+        """
+        if value < 4:
+            index = max(value, 0)
+        else:
+            bits = value.bit_length()
+            index = (bits - 2) * 4 + ((value >> (bits - 3)) & 3)
+        self.counts[index] += 1
+        self.count += 1
+        if value > self.max:
+            self.max = value
+
+    def percentile(self, percent):
+        """
+        Get upper bound of percentile
+
+        :param percent: percentile (0..100)
+        :return: duration (microseconds)
+        """
+        if not self.count:
+            return 0
+        rank = self.count * percent / 100
+        total = 0
+        for index, count in enumerate(self.counts):
+            total += count
+            if total >= rank:
+                if index < 4:
+                    return index
+                shift = index // 4 - 1
+                return min((((index % 4) + 5) << shift) - 1, self.max)
+        return self.max
+
+    def reset(self):
+        self.counts = [0] * len(self.counts)
+        self.count = 0
+        self.max = 0
+
+
+class Tracer:
+    """
+    Input to PWM latency tracer.
+    Values are queued and flushed by input, control, ramp, failsafe and PWM threads,
+    so histograms and per-channel stamps are updated under a lock.
+    Read and dispatch stamps are written only by the input thread.
+    """
+
+    def __init__(self, channels=16):
+        """
+        :param channels: number of PWM channels
+        """
+        self.histograms = {stage: Histogram() for stage in STAGES}
+        self._read = 0
+        self._dispatch = 0
+        self._channel_read = [0] * channels
+        self._channel_queue = [0] * channels
+        self._lock = threading.Lock()
+
+    def read(self):
+        """
+        Stamp input events read
+
+        :return: None
+        """
+        self._read = time.perf_counter_ns()
+        self._dispatch = 0
+
+    def event(self, timestamp):
+        """
+        Record delay between input event and read
+
+        :param timestamp: event timestamp (seconds, CLOCK_REALTIME)
+        :return: None
+        """
+        with self._lock:
+            self.histograms['kernel'].add(int((time.time() - timestamp) * 1000000))
+
+    def dispatch(self):
+        """
+        Stamp call of input handler
+
+        :return: None
+        """
+        self._dispatch = time.perf_counter_ns()
+        if self._read:
+            with self._lock:
+                self.histograms['dispatch'].add((self._dispatch - self._read) // 1000)
+
+    def queue(self, channel):
+        """
+        Stamp PWM value queued
+
+        :param channel: channel number
+        :return: None
+        """
+        now = time.perf_counter_ns()
+        dispatched = self._dispatch
+        with self._lock:
+            if dispatched:
+                self.histograms['queue'].add((now - dispatched) // 1000)
+            if not self._channel_queue[channel]:
+                self._channel_queue[channel] = now
+                self._channel_read[channel] = self._read
+
+    def flush(self, channels, now=None):
+        """
+        Stamp PWM values written to the chip
+
+        :param channels: list of written channels
+        :param now: time of the write (time.perf_counter_ns), current time if None
+        :return: None
+        """
+        if now is None:
+            now = time.perf_counter_ns()
+        with self._lock:
+            for channel in channels:
+                queued = self._channel_queue[channel]
+                if not queued:
+                    continue
+                self.histograms['flush'].add((now - queued) // 1000)
+                if self._channel_read[channel]:
+                    self.histograms['total'].add((now - self._channel_read[channel]) // 1000)
+                self._channel_queue[channel] = 0
+
+    def dump(self):
+        """
+        Format statistics
+
+        :return: text table
+        """
+        lines = ["{:<10}{:>10}{:>10}{:>10}{:>10}".format('stage', 'count', 'p50 us', 'p99 us', 'max us')]
+        with self._lock:
+            for stage in STAGES:
+                histogram = self.histograms[stage]
+                lines.append("{:<10}{:>10}{:>10}{:>10}{:>10}".format(
+                    stage, histogram.count, histogram.percentile(50), histogram.percentile(99), histogram.max))
+        return "\n".join(lines)
+
+    def reset(self):
+        with self._lock:
+            for histogram in self.histograms.values():
+                histogram.reset()
+
+
+def enable(channels=16):
+    """
+    Enable tracing
+
+    :param channels: number of PWM channels
+    :return: active tracer
+    """
+    global tracer
+    tracer = Tracer(channels)
+    return tracer
@@ -1,77 +1,254 @@
+import asyncio
+import bt_manager
 import car
+import signal
 import time
+import config
 import gamepad
-from gpiozero import LED, Button
-import pydbus
+import latency
+import metrics
+import realtime
+import recorder
+import shared_pwm
+import udp_pad
+from hotplug import HotplugWatcher
+from control import ControlLoop
+from hardware import LED, Button
 
-my_car = car.Car()
+if config.TRACE:
+    latency.enable(16 * len(config.PWM_ADDRESSES))
+if config.RECORD:
+    recorder.start(config.RECORD)
+if config.REALTIME:
+    # settings are inherited by the forked PWM writer process, it locks its memory itself
+    realtime.enable(config.REALTIME_PRIORITY, config.REALTIME_CPUS)
+pwm = None
+if config.MULTIPROCESS:
+    # fork the writer before any thread is started
+    pwm = shared_pwm.SharedPWM(16 * len(config.PWM_ADDRESSES),
+                               batched=config.BATCHED_PWM,
+                               addresses=config.PWM_ADDRESSES)
+    pwm.start()
+my_car = car.Car(steering_table=config.STEERING_TABLE,
+                 batched_pwm=config.BATCHED_PWM,
+                 pwm_thread=not config.ASYNCIO,
+                 pwm_addresses=config.PWM_ADDRESSES,
+                 acceleration=config.MOTOR_ACCELERATION,
+                 deceleration=config.MOTOR_DECELERATION,
+                 pwm=pwm,
+                 failsafe_timeout=config.FAILSAFE_TIMEOUT)
+control = None
+if config.CONTROL_LOOP:
+    control = ControlLoop(my_car.pwm)
+if config.INPUT_BACKEND == 'evdev':
+    pad_classes = (gamepad.EvdevGamePad, gamepad.AsyncEvdevGamePad)
+    device_prefix = 'event'
+elif config.INPUT_BACKEND == 'udp':
+    pad_classes = (udp_pad.UdpGamePad, udp_pad.AsyncUdpGamePad)
+    device_prefix = None
+else:
+    pad_classes = (gamepad.GamePad, gamepad.AsyncGamePad)
+    device_prefix = 'js'
 pad_led = LED(17)
 pad_button = Button(pin=23)
 connected = False
 
 
-def connect_gamepad():
-    if connected:
-        print("connect_gamepad: gamepad is already connected")
-        return
-    gamepad_dev = "5C:BA:37:86:31:97"
-    adapter_path = '/org/bluez/hci0'
-    device_path = f'{adapter_path}/dev_{gamepad_dev.replace(":", "_")}'
-    bluez_service = 'org.bluez'
-    bus = pydbus.SystemBus()
+def on_bluetooth_state(state):
+    """
+    Show bluetooth connection state on LED
 
-    print("Starting bluetooth connection...")
-    pad_led.blink(on_time=0.5, off_time=0.5, n=None, background=True)
-    for i in range(0, 5):
-        try:
-            print("Try #{}".format(i))
-            adapter = bus.get(bluez_service, adapter_path)
-            device = bus.get(bluez_service, device_path)
-            device.Connect()
-            print("Bluetooth is connected")
-            pad_led.on()
-            return
-        except Exception as er:
-            print(str(er))
-            time.sleep(5)
-    print("Bluetooth connection error")
-    pad_led.blink(on_time=0.2, off_time=0.2, n=2)
+    :param state: bt_manager state
+    :return: None
+    """
+    if state == bt_manager.CONNECTING:
+        pad_led.blink(on_time=0.5, off_time=0.5, n=None, background=True)
+    elif state == bt_manager.CONNECTED:
+        pad_led.on()
+    elif state == bt_manager.DISCONNECTED:
+        # don't wait for joystick read error
+        pad_led.off()
+        my_car.on_disconnected()
+    else:
+        pad_led.blink(on_time=0.2, off_time=0.2, n=2)
 
 
-if __name__ == '__main__':
-    xbox_time = 0
-    menu_time = 0
-    pad = None
-    pad_button.when_pressed = connect_gamepad
-    while True:
+bluetooth = bt_manager.BluetoothManager(config.GAMEPAD_ADDRESS, config.BLUETOOTH_ADAPTER, on_bluetooth_state)
+if config.METRICS:
+    metrics.enable(config.METRICS)
+    metrics.active.add_source(my_car.pwm.metrics)
+    metrics.active.add_source(bluetooth.metrics)
+    if my_car.failsafe:
+        metrics.active.add_source(my_car.failsafe.metrics)
+if config.REALTIME:
+    # car, profiles and steering tables are created
+    realtime.preallocate()
+
+
+def create_pad(pad_class):
+    """
+    Create gamepad with attached car handlers
+
+    :param pad_class: one of pad_classes
+    :return: gamepad
+    """
+    pad = pad_class()
+    my_car.attach_gamepad(pad, control)
+    if isinstance(pad, udp_pad.UdpGamePad):
+        pad.key = config.UDP_KEY
+        if metrics.active:
+            metrics.active.add_source(pad.metrics)
+    return pad
+
+
+def open_pad(pad, devices):
+    """
+    Open first suitable device
+
+    :param pad: gamepad
+    :param devices: list of device paths
+    :return: True if device is opened
+    """
+    for dev in devices:
         try:
-            time.sleep(2)
-            pad = gamepad.GamePad()
+            pad.open(dev)
+            return True
+        except OSError as err:
+            print("open_pad: {}".format(str(err)))
+            pad.close()
+    return False
+
+
+def wait_devices(watcher, existing):
+    """
+    Wait for input devices
+
+    :param watcher: HotplugWatcher, None for udp backend
+    :param existing: report existing devices
+    :return: list of device paths or addresses
+    """
+    if watcher is None:
+        if not existing:
+            # address is busy
+            time.sleep(1)
+        return [config.UDP_ADDRESS]
+    return watcher.wait(existing=existing)
 
-            pad.attach_axis(gamepad.AXIS_GAS, my_car.on_forward)
-            pad.attach_axis(gamepad.AXIS_BRAKE, my_car.on_reverse)
-            pad.attach_axis(gamepad.AXIS_X, my_car.on_steering_wheel)
-            pad.attach_axis(gamepad.AXIS_Z, my_car.on_camera_rotate)
-            pad.attach_axis(gamepad.AXIS_HAT0Y, my_car.on_light)
-            pad.attach_button(gamepad.BTN_B, my_car.on_brake)
 
-            pad.open()
+async def wait_devices_async(watcher, existing):
+    """
+    Asyncio version of wait_devices
+
+    :return: list of device paths or addresses
+    """
+    if watcher is None:
+        if not existing:
+            await asyncio.sleep(1)
+        return [config.UDP_ADDRESS]
+    return await watcher.wait_async(existing=existing)
+
+
+def main():
+    global connected
+    pad = create_pad(pad_classes[0])
+    watcher = HotplugWatcher(prefix=device_prefix) if device_prefix else None
+    existing = True
+    realtime.apply('input')
+    if control:
+        control.start()
+    while True:
+        try:
+            # after failure wait for the device node to be created again
+            if not open_pad(pad, wait_devices(watcher, existing)):
+                existing = False
+                continue
 
             print("Connected, starting GamePad loop")
             pad_led.on()
             my_car.on_connected()
             connected = True
+            existing = True
 
             pad.loop()
         except KeyboardInterrupt:
+            if control:
+                control.stop()
             my_car.close()
+            recorder.stop()
             exit(0)
         except Exception as err:
             if connected:
                 pad_led.off()
                 my_car.on_disconnected()
-            if pad:
-                pad.close()
-                pad = None
+            pad.close()
             connected = False
             print("main exception: {}".format(str(err)))
+            if metrics.active:
+                metrics.active.counters().inc(('car_input_errors_total',))
+
+
+async def supervise():
+    """
+    Asyncio version of main loop. Gamepad input, reconnection and PWM flush share one event loop.
+
+    :return: None
+    """
+    global connected
+    realtime.apply('input')
+    # control loop without wrapped handlers only flushes PWM once per period
+    ticker = control or ControlLoop(my_car.pwm)
+    output = asyncio.create_task(ticker.run_async())
+    ramp = asyncio.create_task(my_car.ramp.run_async()) if my_car.ramp else None
+    pad = create_pad(pad_classes[1])
+    watcher = HotplugWatcher(prefix=device_prefix) if device_prefix else None
+    existing = True
+    try:
+        while True:
+            # after failure wait for the device node to be created again
+            if not open_pad(pad, await wait_devices_async(watcher, existing)):
+                existing = False
+                continue
+            existing = True
+            try:
+                print("Connected, starting GamePad loop")
+                pad_led.on()
+                my_car.on_connected()
+                connected = True
+                await pad.run()
+            except Exception as err:
+                print("main exception: {}".format(str(err)))
+                if metrics.active:
+                    metrics.active.counters().inc(('car_input_errors_total',))
+            finally:
+                pad_led.off()
+                my_car.on_disconnected()
+                pad.close()
+                connected = False
+    finally:
+        output.cancel()
+        if ramp:
+            ramp.cancel()
+        if watcher:
+            watcher.close()
+
+
+def dump_latency(signum, frame):
+    print(latency.tracer.dump())
+
+
+if __name__ == '__main__':
+    try:
+        bluetooth.start()
+    except Exception as err:
+        print("Bluetooth is not available: {}".format(str(err)))
+    pad_button.when_pressed = bluetooth.connect
+    if config.TRACE:
+        signal.signal(signal.SIGUSR1, dump_latency)
+    if config.ASYNCIO:
+        try:
+            asyncio.run(supervise())
+        except KeyboardInterrupt:
+            my_car.close()
+            recorder.stop()
+    else:
+        main()
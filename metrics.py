@@ -0,0 +1,168 @@
+"""
+Live metrics in Prometheus text format.
+
+Counters are written only by the thread owning them, every thread gets its own set,
+so counting takes no locks. Counters of all threads are summed when metrics are scraped.
+Gauges and counters kept by other components (PWM, Bluetooth) are read by registered sources.
+
+Usage: curl http://127.0.0.1:9100/metrics
+       curl --unix-socket /run/car/metrics.sock http://localhost/metrics
+"""
+import http.server
+import os
+import socketserver
+import threading
+
+DESCRIPTIONS = {
+    'car_input_events_total': ('counter', "Input events read", ('kind', 'id')),
+    'car_handler_calls_total': ('counter', "Input handler calls", ('kind', 'id')),
+    'car_input_errors_total': ('counter', "Input loop failures", ()),
+}
+""" Thread counters: name -> (type, help, label names) """
+
+active = None
+""" Active metrics registry, None if metrics are disabled """
+
+
+class Counters:
+    """
+    Counters of one thread
+    """
+
+    def __init__(self):
+        self.values = {}
+        """ (name, label values...) -> count """
+
+    def inc(self, key, count=1):
+        """
+        Increment counter
+
+        :param key: tuple (name, label values...)
+        :param count: increment
+        :return: None
+        """
+        self.values[key] = self.values.get(key, 0) + count
+
+
+class Metrics:
+    """
+    Metrics registry and exporter
+    """
+
+    def __init__(self):
+        self._local = threading.local()
+        self._counters = []
+        self._sources = []
+        self._lock = threading.Lock()
+        self._server = None
+
+    def counters(self):
+        """
+        Get counters of the calling thread
+
+        :return: Counters
+        """
+        counters = getattr(self._local, 'counters', None)
+        if counters is None:
+            counters = self._local.counters = Counters()
+            with self._lock:
+                self._counters.append(counters)
+        return counters
+
+    def add_source(self, func):
+        """
+        Register metrics source
+
+        :param func: func() returning list of (name, type, help, value)
+        :return: None
+        """
+        with self._lock:
+            self._sources.append(func)
+
+    def render(self):
+        """
+        Format all metrics
+
+        :return: Prometheus text exposition
+        """
+        with self._lock:
+            counters = list(self._counters)
+            sources = list(self._sources)
+        totals = {}
+        for thread_counters in counters:
+            # copy of dict is atomic, the owner may insert keys meanwhile
+            for key, value in dict(thread_counters.values).items():
+                totals[key] = totals.get(key, 0) + value
+        lines = []
+        for name, (metric_type, description, labels) in DESCRIPTIONS.items():
+            samples = sorted((key, value) for key, value in totals.items() if key[0] == name)
+            if not samples:
+                continue
+            lines.append("# HELP {} {}".format(name, description))
+            lines.append("# TYPE {} {}".format(name, metric_type))
+            for key, value in samples:
+                if labels:
+                    label_text = ",".join('{}="{}"'.format(label, key[i + 1]) for i, label in enumerate(labels))
+                    lines.append("{}{{{}}} {}".format(name, label_text, value))
+                else:
+                    lines.append("{} {}".format(name, value))
+        for source in sources:
+            for name, metric_type, description, value in source():
+                lines.append("# HELP {} {}".format(name, description))
+                lines.append("# TYPE {} {}".format(name, metric_type))
+                lines.append("{} {}".format(name, value))
+        return "\n".join(lines) + "\n"
+
+    def serve(self, address):
+        """
+        Serve metrics over HTTP in a background thread
+
+        :param address: 'host:port' for TCP or path of Unix socket
+        :return: None
+        """
+        registry = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = registry.render().encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        if address.startswith('/'):
+            if os.path.exists(address):
+                os.unlink(address)
+            self._server = UnixHTTPServer(address, Handler)
+        else:
+            host, port = address.rsplit(':', 1)
+            self._server = http.server.ThreadingHTTPServer((host, int(port)), Handler)
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+
+    def close(self):
+        if self._server:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+
+class UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def enable(address=None):
+    """
+    Enable metrics
+
+    :param address: 'host:port' or Unix socket path to serve metrics, None - don't serve
+    :return: active registry
+    """
+    global active
+    active = Metrics()
+    if address:
+        active.serve(address)
+    return active
@@ -0,0 +1,101 @@
+from steering import Steering, SteeringTable
+
+TABLE_SIZE = 1024
+""" Number of entries in throttle and camera lookup tables """
+
+
+class DriveProfile:
+    """
+    Drive profile definition
+    """
+
+    def __init__(self,
+                 name: str,
+                 throttle: float = 1.0,
+                 expo: float = 0.0,
+                 steering_angle: float = 45,
+                 camera_min_angle: float = 40,
+                 camera_max_angle: float = 150):
+        """
+        :param name: profile name
+        :param throttle: maximum throttle (0..1)
+        :param expo: throttle response curve, 0 - linear, 1 - cubic
+        :param steering_angle: maximum wheel angle (degree)
+        :param camera_min_angle: camera angle for the minimum position of controller (degree)
+        :param camera_max_angle: camera angle for the maximum position of controller (degree)
+        """
+        self.name = name
+        self.throttle = throttle
+        self.expo = expo
+        self.steering_angle = steering_angle
+        self.camera_min_angle = camera_min_angle
+        self.camera_max_angle = camera_max_angle
+
+
+class CompiledProfile:
+    """
+    Drive profile compiled to lookup tables. Instances are immutable after creation,
+    so profile can be switched from any thread by replacing the reference.
+    """
+
+    def __init__(self,
+                 profile: DriveProfile,
+                 steering: Steering,
+                 servo_0: int,
+                 servo_180: int,
+                 steering_table: bool = True,
+                 size: int = TABLE_SIZE):
+        """
+        :param profile: profile definition
+        :param steering: steering geometry
+        :param servo_0: servo value for 0 degrees
+        :param servo_180: servo value for 180 degrees
+        :param steering_table: build steering lookup table
+        :param size: number of entries in throttle and camera tables
+        """
+        self.name = profile.name
+        # steering wheel minimum position turns wheels to positive angle
+        self.min_angle = profile.steering_angle
+        self.max_angle = -profile.steering_angle
+        self.steering_table = None
+        if steering_table:
+            self.steering_table = SteeringTable(steering, self.min_angle, self.max_angle, servo_0, servo_180)
+        self._last = size - 1
+        self._throttle_table = []
+        self._camera_table = []
+        for i in range(0, size):
+            position = i / self._last
+            curve = (1 - profile.expo) * position + profile.expo * position * position * position
+            self._throttle_table.append(int(curve * profile.throttle * 4095))
+            angle = profile.camera_min_angle + position * (profile.camera_max_angle - profile.camera_min_angle)
+            self._camera_table.append(int((servo_180 - servo_0) * angle / 180 + servo_0))
+
+    def _index(self, value, min_value, max_value):
+        index = int((value - min_value) * self._last / (max_value - min_value) + 0.5)
+        if index < 0:
+            return 0
+        if index > self._last:
+            return self._last
+        return index
+
+    def throttle(self, value, min_value, max_value):
+        """
+        Get motor duty cycle for throttle controller position
+
+        :param value: current position of throttle controller
+        :param min_value: minimum value for throttle controller position
+        :param max_value: maximum value for throttle controller position
+        :return: duty cycle (0..4095)
+        """
+        return self._throttle_table[self._index(value, min_value, max_value)]
+
+    def camera(self, value, min_value, max_value):
+        """
+        Get camera servo value for camera controller position
+
+        :param value: current position of camera controller
+        :param min_value: minimum value for camera controller position
+        :param max_value: maximum value for camera controller position
+        :return: servo value
+        """
+        return self._camera_table[self._index(value, min_value, max_value)]
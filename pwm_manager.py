@@ -1,46 +1,473 @@
-import Adafruit_PCA9685
+import hardware
+import latency
+import realtime
+import recorder
 import threading
+import time
+from hardware import MODE1, MODE1_AI, LED0_ON_L, ALL_LED_ON_L
+
+BLOCK_CHANNELS = 8
+""" Maximum number of channels in one I2C block transaction (32 bytes) """
+RETRIES = 5
+""" Number of attempts for each I2C transaction """
+FREQUENCY = 60
+""" PWM refresh frequency (Hz) """
+BOARD_CHANNELS = 16
+""" Number of channels of one board """
+
+SAFETY = 0
+""" Priority of safety-critical writes: brake, stop, disconnect """
+CONTROL = 1
+""" Priority of steering and motors """
+AUX = 2
+""" Priority of lights and camera """
+
+
+class Transaction:
+    """
+    Channel values staged by one thread and published to PWM as one frame.
+    Values staged by a `with` block which raised are discarded.
+    """
+
+    def __init__(self, pwm):
+        self._pwm = pwm
+        self.values = []
+        """ List of staged (channel, (on, off), priority) """
+        self.depth = 0
+        self._marks = []
+
+    def __enter__(self):
+        self.depth += 1
+        self._marks.append(len(self.values))
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.depth -= 1
+        mark = self._marks.pop()
+        if exc_type is not None:
+            del self.values[mark:]
+        if self.depth == 0 and self.values:
+            self._pwm.publish(self.values)
+            self.values.clear()
 
 
 class PWM(threading.Thread):
+    """
+    PWM writer owning all PCA9685 boards on the bus. Channels are addressed globally,
+    channel N is channel N % 16 of the board N // 16. All boards are written in one pass.
+    """
 
-    def __init__(self, channels):
-        super().__init__()
-        self.pwm = Adafruit_PCA9685.PCA9685()
-        self.pwm.set_pwm_freq(60)
+    def __init__(self, channels, batched=False, addresses=(hardware.PCA9685_ADDRESS,)):
+        """
+        :param channels: number of channels
+        :param batched: write adjacent channels with auto-increment block transactions
+        :param addresses: I2C addresses of boards
+        """
+        super().__init__(name='pwm')
+        if channels > BOARD_CHANNELS * len(addresses):
+            raise ValueError("{} boards have less than {} channels".format(len(addresses), channels))
+        self.boards = [hardware.PCA9685(address) for address in addresses]
+        self.pwm = self.boards[0]
+        self.frequency = FREQUENCY
+        for board in self.boards:
+            board.set_pwm_freq(self.frequency)
         self._is_stopped = False
         self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
         self._condition = threading.Condition()
         self._channels = [None] * channels
+        self._shadow = [None] * channels
+        self._intended = [None] * channels
+        """ Newest value requested for every channel, rewritten after failed writes and by resync() """
+        self._intended_priority = [CONTROL] * channels
+        self._retry = False
+        self._priority = [CONTROL] * channels
+        self._pending_priority = [CONTROL] * channels
+        self._pending_time = [0.0] * channels
+        self._urgent = False
+        self._local = threading.local()
+        self.deadlines = {SAFETY: None, CONTROL: None, AUX: None}
+        """ Maximum age of queued value for every priority (seconds), None - no limit.
+        A value waiting longer is dropped while values of a more urgent priority are written,
+        the newest value of the channel is queued again in the next PWM period. """
+        self.writes_queued = 0
+        self.writes_issued = 0
+        self.writes_suppressed = 0
+        self.writes_dropped = 0
+        self.writes_failed = 0
+        self.i2c_retries = 0
+        self.i2c_failures = 0
+        self.auto_flush = True
+        """ Wake worker on every set_pwm call. If False, values are written on commit() """
+        self._worker = False
+        self._batched = batched
+        if batched:
+            for board in self.boards:
+                self._set_auto_increment(board)
+
+    def start(self) -> None:
+        self._worker = True
+        super().start()
 
     def run(self) -> None:
+        realtime.apply('pwm')
         with self._condition:
             while True:
-                values = []
-                self._condition.wait()
+                # failed values are retried once per PWM period
+                self._condition.wait(1.0 / self.frequency if self._retry else None)
+                self.flush()
                 if self._is_stopped:
                     break
+
+    def flush(self):
+        """
+        Write all pending channels to the chip.
+        Channels are written by priority, more urgent values queued during the flush go first.
+        Concurrent callers are serialized, so values of one channel are written in order.
+        Values failed in the previous flush are queued again.
+
+        :return: None
+        """
+        with self._flush_lock:
+            if self._retry:
                 with self._lock:
-                    for i in range(0, len(self._channels)):
-                        if self._channels[i] is not None:
-                            values.append((i, self._channels[i]))
-                            self._channels[i] = None
-                for channel, value in values:
-                    for cnt in range(0, 5):
-                        try:
-                            self.pwm.set_pwm(channel, value[0], value[1])
-                            break
-                        except Exception as err:
-                            print("PWM Error: {}".format(str(err)))
+                    self._retry = False
+                    self._requeue()
+            self._flush()
+
+    def _flush(self):
+        while True:
+            with self._lock:
+                priority, values = self._take()
+            if priority is None:
+                break
+            if not values:
+                continue
+            failed = self.writes_failed
+            start = 0
+            while start < len(values):
+                board = values[start][0] // BOARD_CHANNELS
+                end = start + 1
+                while end < len(values) and values[end][0] // BOARD_CHANNELS == board:
+                    end += 1
+                if self._batched:
+                    self._write_batched(priority, board, values[start:end])
+                else:
+                    for channel, value in values[start:end]:
+                        if not self._write(priority, self.boards[board].set_pwm,
+                                           channel % BOARD_CHANNELS, value[0], value[1]):
+                            self._failed(priority, [(channel, value)])
+                start = end
+            self.writes_issued += len(values) - (self.writes_failed - failed)
+            if latency.tracer:
+                latency.tracer.flush([channel for channel, _ in values])
+
+    def _take(self):
+        """
+        Take pending values of the most urgent priority.
+        Must be called with locked _lock.
+
+        :return: tuple (priority, list of (channel, (on, off))), priority is None if nothing is pending
+        """
+        priority = None
+        for i in range(0, len(self._channels)):
+            if self._channels[i] is not None and (priority is None or self._pending_priority[i] < priority):
+                priority = self._pending_priority[i]
+        if priority is None:
+            return None, []
+        # safety-critical values are taken now or none is pending
+        self._urgent = False
+        now = time.monotonic()
+        for i in range(0, len(self._channels)):
+            if self._channels[i] is None or self._pending_priority[i] <= priority:
+                continue
+            deadline = self.deadlines.get(self._pending_priority[i])
+            if deadline is not None and now - self._pending_time[i] > deadline:
+                # the bus is busy with more urgent values, stale ones are not worth waiting for
+                self._channels[i] = None
+                self.writes_dropped += 1
+                self._retry = True
+        values = []
+        for i in range(0, len(self._channels)):
+            if self._channels[i] is None or self._pending_priority[i] != priority:
+                continue
+            values.append((i, self._channels[i]))
+            self._shadow[i] = self._channels[i]
+            self._channels[i] = None
+        return priority, values
+
+    def _write_batched(self, priority, board, values):
+        """
+        Write channels of one board with the minimal number of block transactions.
+        If all channels of the board have the same value ALL_LED registers are used.
+
+        :param priority: priority of values
+        :param board: board index
+        :param values: list of (channel, (on, off)) sorted by channel
+        :return: None
+        """
+        device = self.boards[board]._device
+        if len(values) == BOARD_CHANNELS and all(value == values[0][1] for _, value in values):
+            if not self._write(priority, device.writeList, ALL_LED_ON_L, self._registers(values[0][1])):
+                self._failed(priority, values)
+                # the chip may have been reset
+                self._set_auto_increment(self.boards[board])
+            return
+        start = 0
+        while start < len(values):
+            end = start + 1
+            while (end < len(values) and end - start < BLOCK_CHANNELS and
+                   values[end][0] == values[end - 1][0] + 1):
+                end += 1
+            data = []
+            for _, value in values[start:end]:
+                data.extend(self._registers(value))
+            register = LED0_ON_L + 4 * (values[start][0] % BOARD_CHANNELS)
+            if not self._write(priority, device.writeList, register, data):
+                self._failed(priority, values[start:end])
+                # the chip may have been reset
+                self._set_auto_increment(self.boards[board])
+            start = end
+
+    @staticmethod
+    def _set_auto_increment(board):
+        """
+        Set MODE1 auto-increment bit needed by block transactions. The bit is cleared by chip reset,
+        e.g. after brown-out, then all bytes of a block go to one register.
+
+        :param board: PCA9685 driver
+        :return: True if the bit is set
+        """
+        device = board._device
+        try:
+            mode = device.readU8(MODE1)
+            if not mode & MODE1_AI:
+                device.write8(MODE1, mode | MODE1_AI)
+            return True
+        except Exception as err:
+            print("PWM Error: {}".format(str(err)))
+            return False
+
+    @staticmethod
+    def _registers(value):
+        on, off = value
+        return [on & 0xFF, on >> 8, off & 0xFF, off >> 8]
+
+    def _write(self, priority, func, *args):
+        """
+        Call I2C write function with retries.
+        Retries of not safety-critical write are abandoned when safety-critical value is queued.
+
+        :param priority: priority of written values
+        :return: True if write succeeded
+        """
+        for cnt in range(0, RETRIES):
+            try:
+                func(*args)
+                return True
+            except Exception as err:
+                print("PWM Error: {}".format(str(err)))
+            self.i2c_retries += 1
+            if priority != SAFETY and self._urgent:
+                break
+        self.i2c_failures += 1
+        return False
+
+    def _failed(self, priority, values):
+        """
+        Forget committed values of failed channels, so next write is not suppressed.
+        Values abandoned for safety-critical write are queued again at once,
+        other failed values are retried by the next flush.
+
+        :param priority: priority of values
+        :param values: list of (channel, (on, off))
+        :return: None
+        """
+        with self._lock:
+            self.writes_failed += len(values)
+            requeue = priority != SAFETY and self._urgent
+            for channel, value in values:
+                self._shadow[channel] = None
+                if requeue and self._channels[channel] is None:
+                    self._channels[channel] = value
+                    self._pending_priority[channel] = priority
+                    self._pending_time[channel] = time.monotonic()
+            if not requeue:
+                self._retry = True
+
+    def _requeue(self):
+        """
+        Queue intended values of channels which are not committed. Must be called with locked _lock.
+
+        :return: None
+        """
+        now = time.monotonic()
+        for i in range(0, len(self._channels)):
+            if self._channels[i] is None and self._intended[i] is not None and self._shadow[i] != self._intended[i]:
+                self._channels[i] = self._intended[i]
+                self._pending_priority[i] = self._intended_priority[i]
+                self._pending_time[i] = now
+
+    def metrics(self):
+        """
+        Metrics source, see metrics.Metrics.add_source
+
+        :return: list of (name, type, help, value)
+        """
+        return [
+            ('car_pwm_writes_queued_total', 'counter', "PWM values queued", self.writes_queued),
+            ('car_pwm_writes_issued_total', 'counter', "PWM values written to the chip", self.writes_issued),
+            ('car_pwm_writes_suppressed_total', 'counter', "PWM values equal to the committed ones",
+             self.writes_suppressed),
+            ('car_pwm_writes_dropped_total', 'counter', "Stale PWM values dropped for more urgent ones",
+             self.writes_dropped),
+            ('car_pwm_writes_failed_total', 'counter', "PWM values not written after all retries",
+             self.writes_failed),
+            ('car_i2c_retries_total', 'counter', "Failed I2C transaction attempts", self.i2c_retries),
+            ('car_i2c_failures_total', 'counter', "I2C transactions failed after all retries", self.i2c_failures),
+            ('car_pwm_queue_depth', 'gauge', "PWM channels waiting for write", self.queue_depth()),
+        ]
+
+    def queue_depth(self):
+        """
+        :return: number of channels waiting for write
+        """
+        return sum(1 for value in self._channels if value is not None)
+
+    def set_deadline(self, priority, deadline):
+        """
+        Set maximum age of queued values of priority
+
+        :param priority: SAFETY, CONTROL or AUX
+        :param deadline: seconds, None - no limit
+        :return: None
+        """
+        self.deadlines[priority] = deadline
+
+    def set_priority(self, channels, priority):
+        """
+        Set default priority of channels
+
+        :param channels: list of channels
+        :param priority: SAFETY, CONTROL or AUX
+        :return: None
+        """
+        for channel in channels:
+            self._priority[channel] = priority
+
+    def resync(self):
+        """
+        Force rewriting of all known channel values, e.g. after I2C error or chip reset
+
+        :return: None
+        """
+        if self._batched:
+            for board in self.boards:
+                self._set_auto_increment(board)
+        with self._lock:
+            self._shadow = [None] * len(self._shadow)
+            self._requeue()
+        self.commit()
 
     def stop(self):
+        if not self._worker:
+            return
         with self._condition:
             self._is_stopped = True
             self._condition.notify_all()
         self.join()
 
-    def set_pwm(self, channel, on, off):
+    def transaction(self):
+        """
+        Get transaction of the calling thread.
+        Values set in the transaction are published to the worker at once when the outermost
+        `with` block exits, so the worker never writes a half-updated frame.
+
+        :return: context manager
+        """
+        transaction = getattr(self._local, 'transaction', None)
+        if transaction is None:
+            transaction = self._local.transaction = Transaction(self)
+        return transaction
+
+    def set_pwm(self, channel, on, off, priority=None):
+        """
+        Queue channel value. Value equal to the committed one is dropped.
+        Inside transaction the value is staged until the transaction ends.
+
+        :param channel: channel number
+        :param on: tick when signal goes on
+        :param off: tick when signal goes off
+        :param priority: priority of the value, default priority of channel if None
+        :return: None
+        """
+        if recorder.active:
+            recorder.active.pwm(channel, on, off)
+        if priority is None:
+            priority = self._priority[channel]
+        transaction = getattr(self._local, 'transaction', None)
+        if transaction is not None and transaction.depth:
+            transaction.values.append((channel, (on, off), priority))
+            return
         with self._lock:
-            self._channels[channel] = (on, off)
+            queued = self._queue(channel, (on, off), priority, time.monotonic())
+        if queued:
+            if latency.tracer:
+                latency.tracer.queue(channel)
+            if self.auto_flush:
+                self.commit()
+
+    def publish(self, values):
+        """
+        Queue several channel values as one frame with one lock acquisition and one wakeup.
+        All values of the frame get the most urgent priority among them, so they are written together.
+
+        :param values: list of (channel, (on, off), priority)
+        :return: None
+        """
+        priority = min(value[2] for value in values)
+        now = time.monotonic()
+        queued = False
+        with self._lock:
+            for channel, value, _ in values:
+                queued = self._queue(channel, value, priority, now) or queued
+        if queued:
+            if latency.tracer:
+                for channel, _, _ in values:
+                    latency.tracer.queue(channel)
+            if self.auto_flush:
+                self.commit()
+
+    def _queue(self, channel, value, priority, now):
+        """
+        Queue channel value, replacing the pending one. Must be called with locked _lock.
+
+        :return: False if value is equal to the committed one
+        """
+        self._intended[channel] = value
+        self._intended_priority[channel] = priority
+        if self._shadow[channel] == value:
+            self._channels[channel] = None
+            self.writes_suppressed += 1
+            return False
+        # priority goes with the value, so all values of a published frame are taken together
+        self._pending_priority[channel] = priority
+        self._pending_time[channel] = now
+        self._channels[channel] = value
+        self.writes_queued += 1
+        if priority == SAFETY:
+            self._urgent = True
+        return True
+
+    def commit(self):
+        """
+        Wake worker to write all queued values.
+        If worker thread is not started values are written in the caller thread.
+
+        :return: None
+        """
+        if not self._worker:
+            self.flush()
+            return
         with self._condition:
             self._condition.notify_all()
@@ -0,0 +1,163 @@
+"""
+Real-time scheduling of control threads.
+
+Threads call apply() when they start. With real-time mode enabled the calling thread gets
+SCHED_FIFO priority of its role and is pinned to the configured CPUs. Missing permissions
+are logged and the thread keeps the default scheduling.
+
+Usage: python3 realtime.py [--priority 50] [--cpus 3] [--period 0.0166] [--count 1000]
+"""
+import ctypes
+import ctypes.util
+import gc
+import os
+import threading
+import time
+import latency
+
+MCL_CURRENT = 1
+MCL_FUTURE = 2
+
+ROLES = {'pwm': 0, 'failsafe': 0, 'control': 5, 'input': 10}
+""" Thread roles: role -> priority decrease from the base priority """
+
+active = None
+""" Active real-time settings, None if real-time mode is disabled """
+
+
+class Settings:
+    """
+    Real-time settings of the process
+    """
+
+    def __init__(self, priority=50, cpus=None):
+        """
+        :param priority: SCHED_FIFO priority of PWM writer, other roles get lower priorities
+        :param cpus: set of CPUs for real-time threads, None - don't pin
+        """
+        self.priority = priority
+        self.cpus = cpus
+
+    def apply(self, role):
+        """
+        Set scheduling of the calling thread
+
+        :param role: one of ROLES
+        :return: True if SCHED_FIFO priority is set
+        """
+        name = threading.current_thread().name
+        tid = threading.get_native_id()
+        if self.cpus:
+            try:
+                os.sched_setaffinity(tid, self.cpus)
+            except OSError as err:
+                print("Realtime: {} can't be pinned to CPUs {}: {}".format(name, sorted(self.cpus), str(err)))
+        priority = max(self.priority - ROLES[role], 1)
+        try:
+            os.sched_setscheduler(tid, os.SCHED_FIFO, os.sched_param(priority))
+        except OSError as err:
+            print("Realtime: {} keeps default scheduling: {}".format(name, str(err)))
+            return False
+        print("Realtime: {} runs with SCHED_FIFO priority {}".format(name, priority))
+        return True
+
+
+def lock_memory():
+    """
+    Lock current and future pages of the process in memory
+
+    :return: True if memory is locked
+    """
+    libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    if libc.mlockall(MCL_CURRENT | MCL_FUTURE) != 0:
+        print("Realtime: memory is not locked: {}".format(os.strerror(ctypes.get_errno())))
+        return False
+    return True
+
+
+def preallocate():
+    """
+    Move all objects created during start to the permanent generation,
+    so garbage collection in the hot loop scans only new objects
+
+    :return: None
+    """
+    gc.collect()
+    gc.freeze()
+
+
+def enable(priority=50, cpus=None):
+    """
+    Enable real-time mode and lock memory of the process. Call before control threads are started
+    and call preallocate() after start objects are created.
+    Memory locks are not inherited by fork(), forked processes call lock_memory() again.
+
+    :param priority: SCHED_FIFO priority of PWM writer
+    :param cpus: set of CPUs for real-time threads, None - don't pin
+    :return: active settings
+    """
+    global active
+    active = Settings(priority, cpus)
+    lock_memory()
+    return active
+
+
+def apply(role):
+    """
+    Set scheduling of the calling thread if real-time mode is enabled
+
+    :param role: one of ROLES
+    :return: None
+    """
+    if active:
+        active.apply(role)
+
+
+def jitter_test(period=1 / 60, count=1000, role='pwm'):
+    """
+    Measure wakeup latency of a periodic thread
+
+    :param period: wakeup period (seconds)
+    :param count: number of wakeups
+    :param role: scheduling role of the test thread
+    :return: latency.Histogram of wakeup delays (microseconds)
+    """
+    histogram = latency.Histogram()
+
+    def run():
+        apply(role)
+        next_time = time.monotonic()
+        for _ in range(0, count):
+            next_time += period
+            delay = next_time - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            histogram.add(int((time.monotonic() - next_time) * 1000000))
+
+    thread = threading.Thread(target=run, name='jitter-test')
+    thread.start()
+    thread.join()
+    return histogram
+
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(description="Wakeup jitter self-test")
+    parser.add_argument('--priority', type=int, default=50, help="SCHED_FIFO priority, 0 - default scheduling")
+    parser.add_argument('--cpus', help="comma separated list of CPUs")
+    parser.add_argument('--period', type=float, default=1 / 60, help="wakeup period (seconds)")
+    parser.add_argument('--count', type=int, default=1000, help="number of wakeups")
+    args = parser.parse_args()
+
+    if args.priority:
+        enable(args.priority, {int(cpu) for cpu in args.cpus.split(',')} if args.cpus else None)
+        preallocate()
+    histogram = jitter_test(args.period, args.count)
+    print("{:>10}{:>10}{:>10}{:>10}{:>10}".format('count', 'p50 us', 'p99 us', 'p99.9 us', 'max us'))
+    print("{:>10}{:>10}{:>10}{:>10}{:>10}".format(
+        histogram.count, histogram.percentile(50), histogram.percentile(99), histogram.percentile(99.9),
+        histogram.max))
+
+
+if __name__ == '__main__':
+    main()
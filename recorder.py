@@ -0,0 +1,277 @@
+"""
+Binary record and replay of driving sessions.
+
+Log file consists of a header and fixed-size little-endian records, so it can be memory mapped
+and appended. Input events read in one system call share the timestamp, so replay reproduces
+the batching of the live session.
+
+Usage: python3 recorder.py dump FILE
+       python3 recorder.py replay FILE [--fast]
+"""
+import mmap
+import os
+import struct
+import threading
+import time
+
+HEADER = struct.Struct('<8sII')
+""" File header: magic, version, record size """
+MAGIC = b'CARREC\0\0'
+VERSION = 2
+RECORD = struct.Struct('<qBBHiIi')
+""" Record: timestamp (ns, monotonic), kind, type, number, value, extra (unsigned), extra2 """
+CHUNK = 4096
+""" Number of records buffered before writing to file """
+
+KIND_JS_EVENT = 1
+""" Joystick event: type, number, value, extra - event time (ms, wraps around) """
+KIND_JS_AXIS = 2
+""" Joystick axis map entry: number - axis number, value - axis id """
+KIND_JS_BUTTON = 3
+""" Joystick button map entry: number - button number, value - button id """
+KIND_EVDEV_EVENT = 4
+""" evdev event: type, number - code, value, extra - event time (sec), extra2 - event time (usec) """
+KIND_EVDEV_ABS = 5
+""" evdev axis range: number - axis code, value - minimum, extra2 - maximum """
+KIND_PWM = 6
+""" PWM.set_pwm call: number - channel, value - on, extra - off """
+KIND_EVDEV_STATE = 7
+""" evdev state read after dropped events: type - EV_ABS or EV_KEY, number - code, value """
+
+active = None
+""" Active recorder, None if recording is disabled """
+
+
+class Recorder:
+    """
+    Session recorder. Records are packed into a preallocated buffer which is written
+    to the file when it is full, so recording does not allocate per event.
+    """
+
+    def __init__(self, path, chunk=CHUNK):
+        """
+        :param path: log file, appended if exists
+        :param chunk: number of records buffered before writing
+        """
+        self._fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+        size = os.fstat(self._fd).st_size
+        if size == 0:
+            os.write(self._fd, HEADER.pack(MAGIC, VERSION, RECORD.size))
+        elif (size - HEADER.size) % RECORD.size:
+            # drop partial record left by crash
+            os.ftruncate(self._fd, size - (size - HEADER.size) % RECORD.size)
+        self._buffer = bytearray(RECORD.size * chunk)
+        self._view = memoryview(self._buffer)
+        self._chunk = chunk
+        self._count = 0
+        self._lock = threading.Lock()
+
+    def record(self, timestamp, kind, ev_type, number, value, extra=0, extra2=0):
+        """
+        Append record
+
+        :param timestamp: time.monotonic_ns() value
+        :param kind: record kind (KIND_*)
+        :param extra: unsigned 32-bit field
+        :param extra2: signed 32-bit field
+        :return: None
+        """
+        with self._lock:
+            RECORD.pack_into(self._buffer, self._count * RECORD.size,
+                             timestamp, kind, ev_type, number, value, extra, extra2)
+            self._count += 1
+            if self._count == self._chunk:
+                self._flush()
+
+    def pwm(self, channel, on, off):
+        """
+        Record PWM.set_pwm call
+
+        :return: None
+        """
+        self.record(time.monotonic_ns(), KIND_PWM, 0, channel, on, off)
+
+    def _flush(self):
+        os.write(self._fd, self._view[:self._count * RECORD.size])
+        self._count = 0
+
+    def flush(self):
+        with self._lock:
+            self._flush()
+
+    def close(self):
+        if self._fd is not None:
+            self.flush()
+            os.close(self._fd)
+            self._fd = None
+
+
+def start(path):
+    """
+    Start recording
+
+    :param path: log file
+    :return: active recorder
+    """
+    global active
+    active = Recorder(path)
+    return active
+
+
+def stop():
+    """
+    Stop recording
+
+    :return: None
+    """
+    global active
+    if active:
+        active.close()
+        active = None
+
+
+class Replayer:
+    """
+    Session log reader and replayer
+    """
+
+    def __init__(self, path):
+        """
+        :param path: log file
+        """
+        with open(path, 'rb') as file:
+            self._map = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, record_size = HEADER.unpack_from(self._map, 0)
+        if magic != MAGIC or version != VERSION or record_size != RECORD.size:
+            raise ValueError("{} is not a session log".format(path))
+        count = (len(self._map) - HEADER.size) // RECORD.size
+        self.records = memoryview(self._map)[HEADER.size:HEADER.size + count * RECORD.size]
+
+    def __len__(self):
+        return len(self.records) // RECORD.size
+
+    def __iter__(self):
+        """
+        :return: iterator of (timestamp, kind, type, number, value, extra, extra2)
+        """
+        return RECORD.iter_unpack(self.records)
+
+    def close(self):
+        self.records.release()
+        self._map.close()
+
+    def replay(self, my_car, realtime=True):
+        """
+        Drive the car by recorded input events
+
+        :param my_car: car
+        :param realtime: keep recorded timing, otherwise replay as fast as possible
+        :return: number of replayed input events
+        """
+        import gamepad
+        pad = None
+        read_fd, write_fd = os.pipe()
+        os.set_blocking(read_fd, False)
+        axis_map = {}
+        buttons_map = {}
+        abs_range = {}
+        state = {}
+        batch = []
+        batch_time = None
+        first_time = None
+        start = time.monotonic_ns()
+        count = 0
+
+        def process():
+            os.write(write_fd, b''.join(batch))
+            batch.clear()
+            pad.process()
+
+        try:
+            for timestamp, kind, ev_type, number, value, extra, extra2 in self:
+                if kind in (KIND_JS_AXIS, KIND_JS_BUTTON, KIND_EVDEV_ABS):
+                    if pad:
+                        # device is reopened
+                        if batch:
+                            process()
+                        pad = None
+                        axis_map, buttons_map, abs_range = {}, {}, {}
+                    if kind == KIND_JS_AXIS:
+                        axis_map[number] = value
+                    elif kind == KIND_JS_BUTTON:
+                        buttons_map[number] = value
+                    else:
+                        abs_range[number] = (value, extra2)
+                    continue
+                if kind == KIND_EVDEV_STATE:
+                    # recorded after the events of its batch, the batch is processed later
+                    state[(ev_type, number)] = value
+                    continue
+                if kind not in (KIND_JS_EVENT, KIND_EVDEV_EVENT):
+                    continue
+
+                if batch and timestamp != batch_time:
+                    process()
+                if not pad:
+                    if kind == KIND_JS_EVENT:
+                        pad = gamepad.GamePad()
+                        pad.attach_device(read_fd,
+                                          [axis_map.get(i, -1) for i in range(0, len(axis_map))],
+                                          [buttons_map.get(i, -1) for i in range(0, len(buttons_map))])
+                    else:
+                        pad = gamepad.EvdevGamePad()
+                        pad.attach_device(read_fd, abs_range)
+                        pad.replay_state = state
+                    my_car.attach_gamepad(pad)
+                if realtime:
+                    if first_time is None:
+                        first_time = timestamp
+                    delay = (timestamp - first_time) - (time.monotonic_ns() - start)
+                    if delay > 0:
+                        time.sleep(delay / 1000000000)
+                batch_time = timestamp
+                if kind == KIND_JS_EVENT:
+                    batch.append(gamepad.JS_EVENT.pack(extra, value, ev_type, number))
+                else:
+                    batch.append(gamepad.INPUT_EVENT.pack(extra, extra2, ev_type, number, value))
+                count += 1
+            if batch:
+                process()
+        finally:
+            os.close(read_fd)
+            os.close(write_fd)
+        return count
+
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(description="Session log tool")
+    parser.add_argument('command', choices=('dump', 'replay'))
+    parser.add_argument('file')
+    parser.add_argument('--fast', action='store_true', help="replay as fast as possible")
+    args = parser.parse_args()
+
+    replayer = Replayer(args.file)
+    if args.command == 'dump':
+        names = {KIND_JS_EVENT: 'js', KIND_JS_AXIS: 'js_axis', KIND_JS_BUTTON: 'js_button',
+                 KIND_EVDEV_EVENT: 'evdev', KIND_EVDEV_ABS: 'evdev_abs', KIND_PWM: 'pwm',
+                 KIND_EVDEV_STATE: 'evdev_state'}
+        for timestamp, kind, ev_type, number, value, extra, extra2 in replayer:
+            print("{:.6f}\t{}\t{}\t{}\t{}\t{}\t{}".format(
+                timestamp / 1000000000, names.get(kind, kind), ev_type, number, value, extra, extra2))
+    else:
+        os.environ.setdefault('CAR_HARDWARE', 'mock')
+        import car
+        import config
+        my_car = car.Car(steering_table=config.STEERING_TABLE, batched_pwm=config.BATCHED_PWM)
+        try:
+            start_time = time.perf_counter()
+            count = replayer.replay(my_car, realtime=not args.fast)
+            print("Replayed {} events in {:.3f} s".format(count, time.perf_counter() - start_time))
+        finally:
+            my_car.close()
+    replayer.close()
+
+
+if __name__ == '__main__':
+    main()
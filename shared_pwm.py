@@ -0,0 +1,382 @@
+"""
+PWM writer in a separate process.
+
+Input and control process publishes channel frames to a seqlock protected table in shared memory
+and wakes the writer process through a non-blocking pipe. The writer process owns the PCA9685 boards
+and writes changed channels with pwm_manager.PWM. Neither side takes a lock shared with the other,
+so output timing doesn't depend on the GIL of the input process.
+"""
+import multiprocessing
+import os
+import select
+import struct
+import threading
+import time
+from multiprocessing import shared_memory
+import hardware
+import latency
+import realtime
+import recorder
+from pwm_manager import PWM, Transaction, CONTROL, SAFETY, AUX, FREQUENCY
+
+HEADER = struct.Struct('<I3f')
+""" Table header: sequence number, deadlines of SAFETY, CONTROL and AUX priorities (seconds, 0 - no limit) """
+CHANNEL = struct.Struct('<HHBx')
+""" Channel entry: on, off, priority """
+ACK = struct.Struct('<Iq')
+""" Written by the writer process after the channel entries:
+sequence number of the last written table, time of the write (time.perf_counter_ns) """
+STATS = struct.Struct('<5QI')
+""" Written by the writer process after ACK:
+writes issued, failed and dropped, I2C retries and failures, queue depth """
+UNSET = 0xFF
+""" Priority of channel never set """
+READ_RETRIES = 3
+""" Attempts to read consistent table before the writer waits for the next wakeup """
+FLUSH_TIMEOUT = 0.1
+""" Maximum wait for the writer process in flush() (seconds) """
+
+
+class SharedPWM:
+    """
+    PWM manager interface writing to shared memory table.
+    The writer process is forked by start().
+    """
+
+    def __init__(self, channels, batched=False, addresses=(hardware.PCA9685_ADDRESS,)):
+        """
+        :param channels: number of channels
+        :param batched: write adjacent channels with auto-increment block transactions
+        :param addresses: I2C addresses of boards
+        """
+        self._memory = shared_memory.SharedMemory(create=True,
+                                                  size=HEADER.size + CHANNEL.size * channels + ACK.size + STATS.size)
+        self._buffer = self._memory.buf
+        self._batched = batched
+        self._addresses = addresses
+        self._table = [None] * channels
+        self._priority = [CONTROL] * channels
+        self.deadlines = {SAFETY: None, CONTROL: None, AUX: None}
+        self.frequency = FREQUENCY
+        self._seq = 0
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._changed = False
+        self._traced = []
+        """ List of (sequence number, channels) of frames waiting for the writer, stamped by the tracer """
+        self._read_fd = None
+        self._write_fd = None
+        self._process = None
+        self.frames_published = 0
+        self.writes_queued = 0
+        self.writes_suppressed = 0
+        self.auto_flush = True
+        """ Wake writer on every change. If False, the writer is woken by commit() """
+        self._write_header()
+        for channel in range(0, channels):
+            CHANNEL.pack_into(self._buffer, HEADER.size + CHANNEL.size * channel, 0, 0, UNSET)
+        ACK.pack_into(self._buffer, HEADER.size + CHANNEL.size * channels, self._seq, 0)
+        STATS.pack_into(self._buffer, HEADER.size + CHANNEL.size * channels + ACK.size, 0, 0, 0, 0, 0, 0)
+
+    def start(self):
+        """
+        Fork the writer process. Call before other threads are started.
+
+        :return: None
+        """
+        self._read_fd, self._write_fd = os.pipe()
+        os.set_blocking(self._write_fd, False)
+        context = multiprocessing.get_context('fork')
+        self._process = context.Process(target=run_writer,
+                                        args=(self._memory.name, len(self._table), self._batched,
+                                              self._addresses, self._read_fd, self._write_fd),
+                                        daemon=True)
+        self._process.start()
+        os.close(self._read_fd)
+        self._read_fd = None
+
+    def stop(self):
+        if self._process is None:
+            return
+        self.commit()
+        # writer exits on end of file
+        os.close(self._write_fd)
+        self._write_fd = None
+        self._process.join()
+        self._process = None
+        self._buffer = None
+        self._memory.close()
+        self._memory.unlink()
+
+    def _write_header(self):
+        HEADER.pack_into(self._buffer, 0, self._seq,
+                         *[self.deadlines[priority] or 0 for priority in (SAFETY, CONTROL, AUX)])
+
+    def _next_seq(self):
+        self._seq = (self._seq + 1) & 0xFFFFFFFF
+        struct.pack_into('<I', self._buffer, 0, self._seq)
+
+    def set_deadline(self, priority, deadline):
+        """
+        Set maximum age of queued values of priority, applied by the writer process
+
+        :param priority: SAFETY, CONTROL or AUX
+        :param deadline: seconds, None - no limit
+        :return: None
+        """
+        with self._lock:
+            self.deadlines[priority] = deadline
+            self._next_seq()
+            self._write_header()
+            self._next_seq()
+
+    def set_priority(self, channels, priority):
+        for channel in channels:
+            self._priority[channel] = priority
+
+    def transaction(self):
+        """
+        Get transaction of the calling thread, see pwm_manager.PWM.transaction
+
+        :return: context manager
+        """
+        transaction = getattr(self._local, 'transaction', None)
+        if transaction is None:
+            transaction = self._local.transaction = Transaction(self)
+        return transaction
+
+    def set_pwm(self, channel, on, off, priority=None):
+        """
+        Publish channel value, inside transaction the value is staged until the transaction ends
+
+        :param channel: channel number
+        :param on: tick when signal goes on
+        :param off: tick when signal goes off
+        :param priority: priority of the value, default priority of channel if None
+        :return: None
+        """
+        if recorder.active:
+            recorder.active.pwm(channel, on, off)
+        if priority is None:
+            priority = self._priority[channel]
+        transaction = getattr(self._local, 'transaction', None)
+        if transaction is not None and transaction.depth:
+            transaction.values.append((channel, (on, off), priority))
+            return
+        self.publish([(channel, (on, off), priority)])
+
+    def publish(self, values):
+        """
+        Write changed values to the table as one frame
+
+        :param values: list of (channel, (on, off), priority)
+        :return: None
+        """
+        priority = min(value[2] for value in values)
+        channels = []
+        with self._lock:
+            for channel, value, _ in values:
+                if self._table[channel] == value:
+                    self.writes_suppressed += 1
+                    continue
+                if not channels:
+                    # odd sequence number marks the table inconsistent
+                    self._next_seq()
+                self._table[channel] = value
+                CHANNEL.pack_into(self._buffer, HEADER.size + CHANNEL.size * channel, value[0], value[1], priority)
+                channels.append(channel)
+                self.writes_queued += 1
+            if not channels:
+                return
+            self._next_seq()
+            self.frames_published += 1
+            self._changed = True
+            if latency.tracer:
+                self._traced.append((self._seq, channels))
+        if latency.tracer:
+            for channel in channels:
+                latency.tracer.queue(channel)
+            self._trace_written()
+        if self.auto_flush:
+            self.commit()
+
+    def commit(self):
+        """
+        Wake the writer process
+
+        :return: None
+        """
+        if not self._changed or self._write_fd is None:
+            return
+        self._changed = False
+        try:
+            os.write(self._write_fd, b'\0')
+        except BlockingIOError:
+            # writer is already woken
+            pass
+
+    def flush(self, timeout=FLUSH_TIMEOUT):
+        """
+        Wake the writer process and wait until it writes the published values
+
+        :param timeout: maximum wait (seconds)
+        :return: True if the values are written
+        """
+        with self._lock:
+            seq = self._seq
+        self.commit()
+        if self._process is None:
+            return False
+        offset = HEADER.size + CHANNEL.size * len(self._table)
+        end = time.monotonic() + timeout
+        while (ACK.unpack_from(self._buffer, offset)[0] - seq) & 0xFFFFFFFF >= 0x80000000:
+            if time.monotonic() > end:
+                return False
+            time.sleep(0.0005)
+        self._trace_written()
+        return True
+
+    def _trace_written(self):
+        """
+        Stamp flush stage of frames acknowledged by the writer process
+
+        :return: None
+        """
+        if not latency.tracer or self._buffer is None:
+            return
+        ack, written = ACK.unpack_from(self._buffer, HEADER.size + CHANNEL.size * len(self._table))
+        with self._lock:
+            done = 0
+            while done < len(self._traced) and (ack - self._traced[done][0]) & 0xFFFFFFFF < 0x80000000:
+                done += 1
+            frames = self._traced[:done]
+            del self._traced[:done]
+        for _, channels in frames:
+            latency.tracer.flush(channels, written)
+
+    def metrics(self):
+        """
+        Metrics source, see metrics.Metrics.add_source
+
+        :return: list of (name, type, help, value)
+        """
+        self._trace_written()
+        issued, failed, dropped, retries, failures, depth = STATS.unpack_from(
+            self._buffer, HEADER.size + CHANNEL.size * len(self._table) + ACK.size)
+        return [
+            ('car_pwm_frames_published_total', 'counter', "Frames published to the writer process",
+             self.frames_published),
+            ('car_pwm_writes_queued_total', 'counter', "PWM values queued", self.writes_queued),
+            ('car_pwm_writes_suppressed_total', 'counter', "PWM values equal to the published ones",
+             self.writes_suppressed),
+            ('car_pwm_writes_issued_total', 'counter', "PWM values written to the chip", issued),
+            ('car_pwm_writes_dropped_total', 'counter', "Stale PWM values dropped for more urgent ones", dropped),
+            ('car_pwm_writes_failed_total', 'counter', "PWM values not written after all retries", failed),
+            ('car_i2c_retries_total', 'counter', "Failed I2C transaction attempts", retries),
+            ('car_i2c_failures_total', 'counter', "I2C transactions failed after all retries", failures),
+            ('car_pwm_queue_depth', 'gauge', "PWM channels waiting for write in the writer process", depth),
+        ]
+
+
+def read_table(buffer, channels, retries=READ_RETRIES):
+    """
+    Read consistent snapshot of the table.
+    The reader doesn't spin while the input process is in the middle of a frame: with real-time
+    priorities on a shared CPU the input process could not run to finish it.
+
+    :param buffer: shared memory buffer
+    :param channels: number of channels
+    :param retries: number of attempts
+    :return: tuple (sequence number, deadlines, list of (on, off, priority)), None if the table is being written
+    """
+    size = HEADER.size + CHANNEL.size * channels
+    for _ in range(0, retries):
+        seq = struct.unpack_from('<I', buffer, 0)[0]
+        if seq & 1:
+            # input process is in the middle of a frame
+            return None
+        data = bytes(buffer[:size])
+        # the copy is consistent if no frame was started while copying
+        if struct.unpack_from('<I', buffer, 0)[0] == seq:
+            header = HEADER.unpack_from(data, 0)
+            return seq, header[1:], list(CHANNEL.iter_unpack(data[HEADER.size:]))
+    return None
+
+
+def write_stats(buffer, offset, pwm):
+    """
+    Write counters of the writer process for metrics of the input process
+
+    :param buffer: shared memory buffer
+    :param offset: offset of STATS
+    :param pwm: pwm_manager.PWM of the writer process
+    :return: None
+    """
+    STATS.pack_into(buffer, offset, pwm.writes_issued, pwm.writes_failed, pwm.writes_dropped,
+                    pwm.i2c_retries, pwm.i2c_failures, pwm.queue_depth())
+
+
+def run_writer(name, channels, batched, addresses, read_fd, write_fd):
+    """
+    Writer process main function
+
+    :param name: shared memory name
+    :param channels: number of channels
+    :param batched: write adjacent channels with auto-increment block transactions
+    :param addresses: I2C addresses of boards
+    :param read_fd: wakeup pipe, end of file stops the writer
+    :param write_fd: input process end of the pipe inherited by fork
+    :return: None
+    """
+    os.close(write_fd)
+    # the log and the tracer belong to the input process, values are recorded and stamped there
+    recorder.active = None
+    latency.tracer = None
+    if realtime.active:
+        # memory locks of the parent are not inherited
+        realtime.lock_memory()
+    realtime.apply('pwm')
+    memory = shared_memory.SharedMemory(name=name)
+    pwm = PWM(channels, batched=batched, addresses=addresses)
+    pwm.start()
+    if realtime.active:
+        realtime.preallocate()
+    last_seq = 0
+    last = [None] * channels
+    period = 1.0 / pwm.frequency
+    ack_offset = HEADER.size + CHANNEL.size * channels
+    stats_offset = ack_offset + ACK.size
+    try:
+        while True:
+            readable, _, _ = select.select([read_fd], [], [], period)
+            if readable and not os.read(read_fd, 4096):
+                break
+            # counters change also when the PWM thread retries failed values
+            write_stats(memory.buf, stats_offset, pwm)
+            snapshot = read_table(memory.buf, channels)
+            if snapshot is None:
+                # keep the last written values, the input process wakes the writer when the frame is complete
+                continue
+            seq, deadlines, table = snapshot
+            if seq == last_seq:
+                continue
+            last_seq = seq
+            for priority, deadline in zip((SAFETY, CONTROL, AUX), deadlines):
+                pwm.set_deadline(priority, deadline or None)
+            values = []
+            for channel, (on, off, priority) in enumerate(table):
+                if priority != UNSET and last[channel] != (on, off):
+                    last[channel] = (on, off)
+                    values.append((channel, (on, off), priority))
+            if values:
+                pwm.publish(values)
+                # values of the table are written when flush() returns
+                pwm.flush()
+            ACK.pack_into(memory.buf, ack_offset, seq, time.perf_counter_ns())
+            write_stats(memory.buf, stats_offset, pwm)
+    finally:
+        # input process is gone, switch outputs off
+        pwm.publish([(channel, (0, 0), SAFETY) for channel in range(0, channels)])
+        pwm.stop()
+        memory.close()
+        os.close(read_fd)
@@ -0,0 +1,6 @@
+import os
+import sys
+
+# config reads the hardware backend at import time
+os.environ['CAR_HARDWARE'] = 'mock'
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,258 @@
+"""
+Input to PWM path on mock hardware
+"""
+import os
+import socket
+import time
+import pytest
+import car
+import gamepad
+import udp_pad
+from control import Failsafe
+from gamepad import EV_ABS, EV_KEY, EV_SYN, SYN_REPORT, SYN_DROPPED, INPUT_EVENT, BTN_A, AXIS_X
+from hardware import MODE1, MODE1_AI
+from pwm_manager import PWM, AUX, CONTROL, SAFETY
+
+
+@pytest.fixture
+def pwm():
+    pwm = PWM(16)
+    pwm.auto_flush = False
+    yield pwm
+    pwm.stop()
+
+
+def event(ev_type, code, value):
+    return INPUT_EVENT.pack(0, 0, ev_type, code, value)
+
+
+def test_failed_write_is_retried(pwm):
+    board = pwm.boards[0]
+    board._device.fail_count = 5
+    pwm.set_pwm(3, 0, 2000)
+    pwm.flush()
+    assert pwm.writes_failed == 1
+    assert pwm.writes_issued == 0
+    pwm.flush()
+    assert board.get_pwm(3) == (0, 2000)
+    assert pwm.writes_issued == 1
+
+
+def test_resync_restores_values_and_auto_increment():
+    pwm = PWM(16, batched=True)
+    pwm.auto_flush = False
+    board = pwm.boards[0]
+    pwm.set_pwm(0, 0, 300)
+    pwm.set_pwm(1, 0, 400)
+    pwm.flush()
+    # chip reset
+    board._device.registers[:] = bytes(256)
+    pwm.resync()
+    pwm.flush()
+    assert board._device.registers[MODE1] & MODE1_AI
+    assert board.get_pwm(0) == (0, 300)
+    assert board.get_pwm(1) == (0, 400)
+
+
+def test_transaction_publishes_one_frame(pwm):
+    with pwm.transaction():
+        pwm.set_pwm(0, 0, 100)
+        with pwm.transaction():
+            pwm.set_pwm(1, 0, 200)
+        assert pwm.queue_depth() == 0
+    assert pwm.queue_depth() == 2
+
+
+def test_transaction_discards_block_which_raised(pwm):
+    with pwm.transaction():
+        pwm.set_pwm(0, 0, 100)
+        with pytest.raises(RuntimeError):
+            with pwm.transaction():
+                pwm.set_pwm(1, 0, 200)
+                raise RuntimeError()
+    pwm.flush()
+    assert pwm.boards[0].get_pwm(0) == (0, 100)
+    assert pwm.boards[0].get_pwm(1) == (0, 0)
+
+
+def test_stale_aux_value_yields_to_control(pwm):
+    pwm.set_priority([12], AUX)
+    pwm.set_deadline(AUX, 0.01)
+    pwm.set_pwm(12, 0, 300)
+    time.sleep(0.02)
+    pwm.set_pwm(0, 0, 400)
+    pwm.flush()
+    assert pwm.writes_dropped == 1
+    assert pwm.boards[0].get_pwm(0) == (0, 400)
+    assert pwm.boards[0].get_pwm(12) == (0, 0)
+    # the newest value is written in the next period
+    pwm.flush()
+    assert pwm.boards[0].get_pwm(12) == (0, 300)
+
+
+def test_safety_value_goes_first(pwm):
+    pwm.set_pwm(0, 0, 100, CONTROL)
+    pwm.set_pwm(1, 0, 200, SAFETY)
+    with pwm._lock:
+        priority, values = pwm._take()
+    assert priority == SAFETY
+    assert values == [(1, (0, 200))]
+
+
+class EvdevPipe:
+    def __init__(self):
+        self.read_fd, self.write_fd = os.pipe()
+        os.set_blocking(self.read_fd, False)
+        self.pad = gamepad.EvdevGamePad()
+        self.pad.attach_device(self.read_fd, {AXIS_X: (-32768, 32767)})
+        self.axis = []
+        self.buttons = []
+        self.pad.attach_axis(AXIS_X, lambda value, min_value, max_value: self.axis.append(value))
+        self.pad.attach_button(BTN_A, self.buttons.append)
+
+    def send(self, *events):
+        os.write(self.write_fd, b''.join(event(*e) for e in events))
+        self.pad.process()
+
+    def close(self):
+        self.pad.close()
+        os.close(self.write_fd)
+
+
+@pytest.fixture
+def evdev():
+    pipe = EvdevPipe()
+    yield pipe
+    pipe.close()
+
+
+def test_evdev_frame_is_dispatched_on_syn_report(evdev):
+    evdev.send((EV_ABS, AXIS_X, 100), (EV_ABS, AXIS_X, 200))
+    assert evdev.axis == []
+    evdev.send((EV_SYN, SYN_REPORT, 0))
+    assert evdev.axis == [200]
+
+
+def test_evdev_dropped_events_restore_state(evdev):
+    evdev.send((EV_KEY, BTN_A, 1), (EV_SYN, SYN_REPORT, 0))
+    # release of the button is lost in the overrun
+    evdev.pad.replay_state.update({(EV_ABS, AXIS_X): 5000, (EV_KEY, BTN_A): 0})
+    evdev.send((EV_SYN, SYN_DROPPED, 0), (EV_KEY, BTN_A, 1), (EV_SYN, SYN_REPORT, 0))
+    assert evdev.buttons == [1, 0]
+    assert evdev.axis == [5000]
+
+
+class UdpLink:
+    def __init__(self, port):
+        self.pad = udp_pad.UdpGamePad(b'key')
+        self.pad.open('127.0.0.1:{}'.format(port))
+        self.address = ('127.0.0.1', port)
+        self.sender = udp_pad.UdpSender('127.0.0.1:{}'.format(port), b'key')
+        self.axis = []
+        self.pad.attach_axis(AXIS_X, lambda value, min_value, max_value: self.axis.append(value))
+
+    def send(self, x, buttons=0):
+        self.sender.send([x, 0, 0, 0, -32767, -32767, 0, 0], buttons)
+        time.sleep(0.005)
+        self.pad.process()
+
+    def close(self):
+        self.sender.close()
+        self.pad.close()
+
+
+@pytest.fixture
+def udp():
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as probe:
+        probe.bind(('127.0.0.1', 0))
+        port = probe.getsockname()[1]
+    link = UdpLink(port)
+    yield link
+    link.close()
+
+
+def test_udp_stale_packet_is_dropped(udp):
+    # the first packet gets the challenge nonce
+    udp.send(100)
+    udp.send(200)
+    assert udp.axis == [200]
+    udp.sender.seq -= 2
+    udp.send(300)
+    assert udp.axis == [200]
+    assert udp.pad.packets_dropped == 2
+
+
+def test_udp_replay_of_previous_session_is_rejected(udp):
+    recorded = []
+    for x in (100, 200):
+        udp.send(x)
+        # the buffer holds the last sent packet
+        recorded.append(bytes(udp.sender._buffer))
+    restarted = udp_pad.UdpSender('{}:{}'.format(*udp.address), b'key')
+    try:
+        for _ in range(0, 3):
+            restarted.send([700, 0, 0, 0, -32767, -32767, 0, 0], 0)
+            time.sleep(0.005)
+            udp.pad.process()
+            time.sleep(udp_pad.CHALLENGE_INTERVAL)
+    finally:
+        restarted.close()
+    assert udp.axis[-1] == 700
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as attacker:
+        for data in recorded:
+            attacker.sendto(data, udp.address)
+    time.sleep(0.005)
+    udp.pad.process()
+    assert udp.axis[-1] == 700
+
+
+def test_failsafe_is_not_tripped_by_late_feed():
+    trips = []
+    failsafe = Failsafe(lambda: trips.append(1), 0.05)
+    failsafe.feed()
+    time.sleep(0.06)
+    # input arrived after the deadline was read by the failsafe thread
+    failsafe.feed()
+    with failsafe._lock:
+        assert failsafe._expired() is None
+    assert trips == []
+
+
+def test_failsafe_trip_dispatches_held_controls_again(udp):
+    my_car = car.Car(failsafe_timeout=0.05)
+    try:
+        my_car.attach_gamepad(udp.pad)
+        board = my_car.pwm.boards[0]
+        for _ in range(0, 3):
+            udp.sender.send([20000, 0, 0, 0, 32767, -32768, 0, 0], 0)
+            time.sleep(0.005)
+            udp.pad.process()
+            my_car.pwm.flush()
+        held = [board.get_pwm(channel) for channel in range(0, 6)]
+        time.sleep(0.2)
+        assert my_car.failsafe.trips == 1
+        assert [board.get_pwm(channel) for channel in range(0, 6)] != held
+        udp.sender.send([20000, 0, 0, 0, 32767, -32768, 0, 0], 0)
+        time.sleep(0.005)
+        udp.pad.process()
+        my_car.pwm.flush()
+        assert [board.get_pwm(channel) for channel in range(0, 6)] == held
+    finally:
+        my_car.close()
+
+
+def test_failsafe_is_fed_only_by_periodic_pads():
+    my_car = car.Car(failsafe_timeout=0.05)
+    read_fd, write_fd = os.pipe()
+    try:
+        pad = gamepad.EvdevGamePad()
+        pad.attach_device(read_fd, {AXIS_X: (-32768, 32767)})
+        my_car.attach_gamepad(pad)
+        os.write(write_fd, event(EV_ABS, AXIS_X, 100) + event(EV_SYN, SYN_REPORT, 0))
+        pad.process()
+        time.sleep(0.15)
+        assert my_car.failsafe.trips == 0
+    finally:
+        my_car.close()
+        os.close(read_fd)
+        os.close(write_fd)
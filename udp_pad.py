@@ -0,0 +1,391 @@
+"""
+Remote control over UDP.
+
+Every packet carries the complete gamepad state and a sequence number. The receiver reads all
+queued packets, drops out-of-order ones and applies only the newest state, so it doesn't fall behind
+whatever the packet rate. Changed axes and buttons are dispatched to the same handlers as GamePad.
+Packets are signed with HMAC-SHA256 of a key shared by the sender and the car (CAR_UDP_KEY),
+without the key the receiver listens only on the loopback interface.
+
+Signed packets could be replayed, so the sequence number never restarts within a sender session.
+A sender picks a random session id when it starts. The receiver accepts a new session only from a
+packet carrying its current challenge nonce, then replaces the nonce. Packets with an unknown session
+and a wrong nonce are answered with a signed challenge packet, the sender puts its nonce into the
+following packets. Recorded packets of earlier sessions carry nonces which are no longer valid.
+
+Usage: python3 udp_pad.py send HOST:PORT [--device /dev/input/js0] [--rate 200] [--key KEY]
+"""
+import hmac
+import ipaddress
+import os
+import select
+import socket
+import struct
+import time
+import gamepad
+import latency
+import metrics
+
+PACKET = struct.Struct('<4sQII8hI')
+""" Signed part of packet: magic, challenge nonce, session id, sequence number, axis values, buttons bit mask """
+CHALLENGE = struct.Struct('<4sQ')
+""" Signed part of challenge packet sent by the receiver: magic, nonce """
+TAG_SIZE = 16
+""" Size of truncated HMAC-SHA256 tag following the signed part """
+MAGIC = b'CAR3'
+CHALLENGE_MAGIC = b'CARN'
+AXES = (gamepad.AXIS_X, gamepad.AXIS_Y, gamepad.AXIS_Z, gamepad.AXIS_RZ,
+        gamepad.AXIS_GAS, gamepad.AXIS_BRAKE, gamepad.AXIS_HAT0X, gamepad.AXIS_HAT0Y)
+""" Axis ids of packet axis values """
+BUTTONS = (gamepad.BTN_A, gamepad.BTN_B, gamepad.BTN_X, gamepad.BTN_Y, gamepad.BTN_TL, gamepad.BTN_TR,
+           gamepad.BTN_TL2, gamepad.BTN_TR2, gamepad.BTN_SELECT, gamepad.BTN_START, gamepad.BTN_MODE,
+           gamepad.BTN_THUMBL, gamepad.BTN_THUMBR)
+""" Button ids of packet button bits """
+ADDRESS = '127.0.0.1:7000'
+""" Default listen address """
+CHALLENGE_INTERVAL = 0.1
+""" Minimum interval of challenge packets (seconds) """
+
+
+def is_newer(seq, last):
+    """
+    Compare 32-bit sequence numbers with wraparound
+
+    :return: True if seq is after last
+    """
+    return seq != last and ((seq - last) & 0xFFFFFFFF) < 0x80000000
+
+
+def random_id(size):
+    """
+    :param size: number of bytes
+    :return: random unsigned integer
+    """
+    return int.from_bytes(os.urandom(size), 'little')
+
+
+def sign(key, data):
+    """
+    Compute packet tag
+
+    :param key: shared key
+    :param data: signed part of packet
+    :return: tag, TAG_SIZE bytes
+    """
+    return hmac.digest(key, data, 'sha256')[:TAG_SIZE]
+
+
+class UdpGamePad(gamepad.GamePad):
+    """
+    GamePad receiving state packets from UDP socket
+    """
+
+    def __init__(self, key=b''):
+        """
+        :param key: key shared with the sender, empty key is allowed only on loopback address
+        """
+        super().__init__()
+        # sender repeats the state at fixed rate
+        self.periodic_reports = True
+        self.key = key
+        self.axis_map = list(AXES)
+        self.buttons_map = list(BUTTONS)
+        self._socket = None
+        # one extra byte detects oversized packets
+        self._buffer = bytearray(PACKET.size + TAG_SIZE + 1)
+        self._view = memoryview(self._buffer)
+        self._seq = None
+        self._session = None
+        self._nonce = random_id(8)
+        self._challenge_time = 0.0
+        self._axis_values = [None] * len(AXES)
+        self._buttons = 0
+        self.packets_received = 0
+        self.packets_dropped = 0
+        """ Malformed, badly signed, out-of-order and unknown session packets """
+        self.packets_skipped = 0
+        """ Valid packets superseded by newer ones read in the same batch """
+
+    def open(self, dev=ADDRESS):
+        """
+        Listen for packets
+
+        :param dev: 'host:port' to bind
+        :return: None
+        """
+        print('Listening %s...' % dev)
+        host, port = dev.rsplit(':', 1)
+        if not self.key and not ipaddress.ip_address(socket.gethostbyname(host)).is_loopback:
+            raise OSError("Refusing to listen on {} without key, set CAR_UDP_KEY".format(dev))
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self._socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._socket.bind((host, int(port)))
+        self._socket.setblocking(False)
+        self.jsdev = self._socket.fileno()
+        self._seq = None
+        self._session = None
+        self._nonce = random_id(8)
+        self._axis_values = [None] * len(AXES)
+        self._buttons = 0
+        self._compile()
+
+    def _forget(self):
+        """
+        Reset dispatched state, the next packet dispatches all axes and pressed buttons
+
+        :return: None
+        """
+        super()._forget()
+        self._axis_values = [None] * len(AXES)
+        self._buttons = 0
+
+    def close(self):
+        if self._socket is not None:
+            self._socket.close()
+            self._socket = None
+            self.jsdev = None
+
+    def process(self):
+        """
+        Read all queued packets and dispatch changes of the newest state
+
+        :return: None
+        """
+        tracer = latency.tracer
+        counters = metrics.active.counters() if metrics.active else None
+        now = time.monotonic()
+        newest = None
+        if not self._compiled:
+            self._compile()
+        while True:
+            try:
+                size, address = self._socket.recvfrom_into(self._buffer)
+            except BlockingIOError:
+                break
+            self.packets_received += 1
+            if size != PACKET.size + TAG_SIZE:
+                self.packets_dropped += 1
+                continue
+            view = self._view
+            if not hmac.compare_digest(sign(self.key, view[:PACKET.size]), view[PACKET.size:size]):
+                self.packets_dropped += 1
+                continue
+            packet = PACKET.unpack_from(self._buffer)
+            if packet[0] != MAGIC:
+                self.packets_dropped += 1
+                continue
+            nonce, session, seq = packet[1:4]
+            if session == self._session:
+                if not is_newer(seq, self._seq):
+                    self.packets_dropped += 1
+                    continue
+            elif nonce == self._nonce:
+                # new sender session, the nonce can't be used again
+                self._session = session
+                self._nonce = random_id(8)
+            else:
+                self.packets_dropped += 1
+                self._challenge(address, now)
+                continue
+            if newest is not None:
+                self.packets_skipped += 1
+            self._seq = seq
+            newest = packet
+        if newest is None:
+            return
+        if tracer:
+            tracer.read()
+        if self._invalidated:
+            self._forget()
+
+        buttons = newest[-1]
+        changed = buttons ^ self._buttons
+        self._buttons = buttons
+        if changed:
+            for bit, button in enumerate(BUTTONS):
+                if not changed >> bit & 1:
+                    continue
+                if counters:
+                    counters.inc(('car_input_events_total', 'button', button))
+                fnc = self._button_handlers[bit]
+                if fnc:
+                    if tracer:
+                        tracer.dispatch()
+                    if counters:
+                        counters.inc(('car_handler_calls_total', 'button', button))
+                    fnc(buttons >> bit & 1)
+
+        for i, axis in enumerate(AXES):
+            value = newest[4 + i]
+            if value == self._axis_values[i]:
+                continue
+            self._axis_values[i] = value
+            if counters:
+                counters.inc(('car_input_events_total', 'axis', axis))
+            if self._dispatch_axis(i, value) and counters:
+                counters.inc(('car_handler_calls_total', 'axis', axis))
+
+        if self.attached_frame:
+            self.attached_frame(now)
+
+    def _challenge(self, address, now):
+        """
+        Send current nonce to the sender of packet with unknown session
+
+        :param address: sender address
+        :param now: time.monotonic() value
+        :return: None
+        """
+        if now - self._challenge_time < CHALLENGE_INTERVAL:
+            return
+        self._challenge_time = now
+        data = CHALLENGE.pack(CHALLENGE_MAGIC, self._nonce)
+        try:
+            self._socket.sendto(data + sign(self.key, data), address)
+        except OSError as e:
+            print("UDP challenge error:", e)
+
+    def metrics(self):
+        """
+        Metrics source, see metrics.Metrics.add_source
+
+        :return: list of (name, type, help, value)
+        """
+        return [
+            ('car_udp_packets_received_total', 'counter', "UDP packets received", self.packets_received),
+            ('car_udp_packets_dropped_total', 'counter',
+             "Malformed, badly signed, out-of-order and unknown session UDP packets", self.packets_dropped),
+            ('car_udp_packets_skipped_total', 'counter', "UDP packets superseded by newer ones",
+             self.packets_skipped),
+        ]
+
+
+class AsyncUdpGamePad(UdpGamePad, gamepad.AsyncGamePad):
+    """
+    UdpGamePad for asyncio event loop.
+    """
+
+
+class UdpSender:
+    """
+    Sender of gamepad state packets
+    """
+
+    def __init__(self, address, key=b''):
+        """
+        :param address: receiver 'host:port'
+        :param key: key shared with the receiver
+        """
+        host, port = address.rsplit(':', 1)
+        self._address = (host, int(port))
+        self._key = key
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self._socket.setblocking(False)
+        self._buffer = bytearray(PACKET.size + TAG_SIZE)
+        # one extra byte detects oversized packets
+        self._challenge = bytearray(CHALLENGE.size + TAG_SIZE + 1)
+        self.session = random_id(4)
+        self.nonce = 0
+        """ Challenge nonce of the receiver, 0 until the first challenge is received """
+        self.seq = 0
+
+    def send(self, axes, buttons):
+        """
+        Send state
+
+        :param axes: list of axis values in AXES order
+        :param buttons: buttons bit mask in BUTTONS order
+        :return: None
+        """
+        self._read_challenges()
+        self.seq = (self.seq + 1) & 0xFFFFFFFF
+        PACKET.pack_into(self._buffer, 0, MAGIC, self.nonce, self.session, self.seq, *axes, buttons)
+        self._buffer[PACKET.size:] = sign(self._key, memoryview(self._buffer)[:PACKET.size])
+        try:
+            self._socket.sendto(self._buffer, self._address)
+        except BlockingIOError:
+            # the next packet carries the state again
+            pass
+
+    def _read_challenges(self):
+        """
+        Take nonce of the newest valid challenge packet
+
+        :return: None
+        """
+        while True:
+            try:
+                size = self._socket.recv_into(self._challenge)
+            except (BlockingIOError, ConnectionRefusedError):
+                break
+            view = memoryview(self._challenge)
+            if size != CHALLENGE.size + TAG_SIZE:
+                continue
+            if not hmac.compare_digest(sign(self._key, view[:CHALLENGE.size]), view[CHALLENGE.size:size]):
+                continue
+            magic, nonce = CHALLENGE.unpack_from(self._challenge)
+            if magic == CHALLENGE_MAGIC:
+                self.nonce = nonce
+
+    def close(self):
+        self._socket.close()
+
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(description="Send local gamepad state to the car over UDP")
+    parser.add_argument('command', choices=('send',))
+    parser.add_argument('address', help="car address HOST:PORT")
+    parser.add_argument('--device', default='/dev/input/js0', help="local joystick device")
+    parser.add_argument('--rate', type=float, default=200, help="packets per second")
+    parser.add_argument('--key', default=os.environ.get('CAR_UDP_KEY', ''), help="key shared with the car")
+    args = parser.parse_args()
+
+    axes = [0] * len(AXES)
+    # triggers are released at the minimum position
+    axes[AXES.index(gamepad.AXIS_GAS)] = -32767
+    axes[AXES.index(gamepad.AXIS_BRAKE)] = -32767
+    state = {'buttons': 0}
+    pad = gamepad.GamePad()
+    pad.open(args.device)
+
+    def axis_handler(index):
+        def handler(value, min_value, max_value):
+            axes[index] = value
+        return handler
+
+    def button_handler(bit):
+        def handler(value):
+            if value:
+                state['buttons'] |= 1 << bit
+            else:
+                state['buttons'] &= ~(1 << bit)
+        return handler
+
+    for index, axis in enumerate(AXES):
+        pad.attach_axis(axis, axis_handler(index))
+    for bit, button in enumerate(BUTTONS):
+        pad.attach_button(button, button_handler(bit))
+
+    sender = UdpSender(args.address, args.key.encode())
+    period = 1.0 / args.rate
+    next_time = time.monotonic()
+    try:
+        while True:
+            delay = next_time - time.monotonic()
+            if delay > 0:
+                readable, _, _ = select.select([pad.fileno()], [], [], delay)
+                if readable:
+                    pad.process()
+                continue
+            sender.send(axes, state['buttons'])
+            next_time = max(next_time + period, time.monotonic())
+    except KeyboardInterrupt:
+        pass
+    finally:
+        sender.close()
+        pad.close()
+
+
+if __name__ == '__main__':
+    main()